@@ -1,15 +1,55 @@
 #!/usr/bin/env python3
 from __future__ import annotations
-import argparse, socket, threading, time, json, random, sys
+import argparse, array, asyncio, bisect, collections, functools, hashlib, itertools, math, operator, os, queue, re, socket, threading, time, json, random, struct, sys, zlib
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait as futures_wait
 from typing import Dict, Tuple, List, Optional
 
 STATE_ALIVE, STATE_SUSPECT, STATE_DEAD = 'ALIVE','SUSPECT','DEAD'
 
 # ------------------------------- Utility ---------------------------------
 
-def recv_all(conn: socket.socket) -> str:
+# Multiplexed mode: a client opens with MUX_MAGIC, then both sides exchange
+# frames of FRAME header (body length, request id) + body. Many requests may be
+# in flight on one connection and responses carry the id of their request, so
+# they can come back in any order. A text body is one line: everything up to
+# its final newline is taken as is, so values keep their bytes. Anything else
+# is the legacy one-shot mode: one command, read until EOF, one reply, close.
+MUX_MAGIC=b'KVMUX/1\n'
+FRAME=struct.Struct('!II')
+
+# Per-request consistency level: GET <key> R=<n> / PUT <key> <value> W=<n>.
+QUORUM=re.compile(r'\s([RW])=(\d+)\s*$', re.I)
+def quorum(raw: str):
+    """The R=/W= suffix of a request; only the tail is searched, so a large value is never scanned."""
+    return QUORUM.search(raw, max(0, len(raw)-64))
+HEAD=re.compile(r'\s*(\S*)')
+def head(raw: str) -> str:
+    """The command word of a request, upper-cased, without copying the rest of it."""
+    return HEAD.match(raw).group(1).upper()
+
+# Keys and values are opaque bytes. In memory they are str, with bytes that
+# are not UTF-8 kept as lone surrogates (PEP 383), so any value round-trips.
+def b2s(b) -> str: return str(b, 'utf-8', 'surrogateescape')
+def s2b(s: str) -> bytes: return s.encode('utf-8', 'surrogateescape')
+def b2line(b) -> str:
+    """A mux frame body as text: byte-exact but for one trailing newline."""
+    s=b2s(b)
+    return s[:-1] if s.endswith('\n') else s
+def trace_value(v: str, n: int=64) -> str:
+    """A value as shown in trace events: large values are cut, with their length."""
+    return v if len(v)<=n else f"{v[:n]}...({len(v)})"
+
+# REPL_BIN frames and WAL records carry the key length in 16 bits. Keys are
+# single protocol tokens (the text commands split on whitespace), which only
+# JSON MPUT could otherwise get around.
+MAX_KEY=65535
+def key_ok(k: str) -> bool:
+    """A key the store accepts: checked before anything is written."""
+    return k.split(None,1)==[k] and (len(k)<=MAX_KEY//4 or len(s2b(k))<=MAX_KEY)
+
+def recv_all(conn: socket.socket, head: bytes=b'') -> str:
     conn.settimeout(3)
-    chunks=[]
+    chunks=[head]
     try:
         while True:
             b=conn.recv(65535)
@@ -17,21 +57,218 @@ def recv_all(conn: socket.socket) -> str:
             chunks.append(b)
     except Exception:
         pass
-    return b''.join(chunks).decode().strip()
+    return b2s(b''.join(chunks)).strip()
+
+def recv_exact(conn: socket.socket, n: int) -> bytes:
+    """Read exactly n bytes into one preallocated buffer; b'' on EOF."""
+    buf=bytearray(n); mv=memoryview(buf); got=0
+    while got<n:
+        r=conn.recv_into(mv[got:])
+        if not r: return b''
+        got+=r
+    return buf
+
+async def aread_head(reader: asyncio.StreamReader) -> bytes:
+    """asyncio counterpart of recv_head."""
+    buf=b''
+    try:
+        while len(buf)<len(MUX_MAGIC) and MUX_MAGIC.startswith(buf):
+            b=await asyncio.wait_for(reader.read(len(MUX_MAGIC)-len(buf)), 3)
+            if not b: break
+            buf+=b
+    except Exception:
+        pass
+    return buf
+
+async def aread_all(reader: asyncio.StreamReader, head: bytes=b'') -> str:
+    """asyncio counterpart of recv_all: read until EOF, 3 s per read."""
+    chunks=[head]
+    try:
+        while True:
+            b=await asyncio.wait_for(reader.read(65535), 3)
+            if not b: break
+            chunks.append(b)
+    except Exception:
+        pass
+    return b2s(b''.join(chunks)).strip()
+
+def recv_head(conn: socket.socket) -> bytes:
+    """Read just enough to tell a multiplexed client from a legacy one."""
+    conn.settimeout(3)
+    buf=b''
+    try:
+        while len(buf)<len(MUX_MAGIC) and MUX_MAGIC.startswith(buf):
+            b=conn.recv(len(MUX_MAGIC)-len(buf))
+            if not b: break
+            buf+=b
+    except Exception:
+        pass
+    return buf
+
+class MuxConn:
+    """Persistent multiplexed connection; safe to share between threads."""
+    def __init__(self, addr: Tuple[str,int], timeout: float=3.0):
+        self.addr=addr
+        self.sock=socket.create_connection(addr, timeout=timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.sendall(MUX_MAGIC); self.sock.settimeout(None)
+        self.wlock=threading.Lock(); self.pending: Dict[int, Future]={}
+        self.next_id=0; self.closed=False
+        threading.Thread(target=self._reader, daemon=True).start()
+
+    def submit(self, cmd) -> Future:
+        """Send a command (str, or an already encoded frame body) and return the future of its reply."""
+        fut: Future=Future(); data=s2b(cmd)+b'\n' if isinstance(cmd, str) else cmd
+        with self.wlock:
+            if self.closed: raise ConnectionError(f"mux to {self.addr} closed")
+            self.next_id=(self.next_id+1)&0xffffffff; rid=self.next_id
+            self.pending[rid]=fut
+            try:
+                hdr=FRAME.pack(len(data), rid)
+                if len(data)<65536: self.sock.sendall(hdr+data)
+                else: self.sock.sendall(hdr); self.sock.sendall(data)  # no copy of large bodies
+            except OSError:
+                self.pending.pop(rid, None); self.close(); raise
+        return fut
+
+    def call(self, cmd: str, timeout: float=3.0) -> str:
+        return self.submit(cmd).result(timeout)
+
+    def _reader(self):
+        try:
+            while True:
+                hdr=recv_exact(self.sock, FRAME.size)
+                if not hdr: break
+                n,rid=FRAME.unpack(hdr); body=recv_exact(self.sock, n)
+                if n and not body: break
+                fut=self.pending.pop(rid, None)
+                if fut: fut.set_result(b2line(body))
+        except Exception:
+            pass
+        self.close()
+
+    def close(self):
+        self.closed=True
+        try: self.sock.close()
+        except: pass
+        for rid in list(self.pending):
+            fut=self.pending.pop(rid, None)
+            if fut and not fut.done(): fut.set_exception(ConnectionError(f"mux to {self.addr} closed"))
 
 # ------------------------------- Logger ----------------------------------
 
+class CausalIndex:
+    """
+    Incremental vector-clock partial order. An event's layer is the length of
+    the longest happened-before chain ending at it, i.e. the layer the old
+    peel-off-the-minimal-events loop gave it.
+
+    For an event o of node j, o -> e iff o.V[j] <= e.V[j]. Per node the events
+    are kept sorted by their own clock entry; along that order layers never
+    decrease, so e's deepest predecessor on node j is the last one at or below
+    e.V[j] and a new event is placed with one bisect per node. An event that
+    arrives late can push already-placed successors down; only those suffixes
+    are walked, and a walk stops at the first event that is already deep enough.
+    """
+    def __init__(self):
+        self.own: Dict[int, List[int]]={}           # node -> own clock entries, sorted
+        self.evs: Dict[int, List['TraceEvent']]={}  # node -> events, same order
+        self.lay: Dict[int, List[int]]={}           # node -> layer of each event
+        self.col: Dict[int, Dict[int, List[int]]]={} # node k -> j -> V[j] of k's events (non-decreasing)
+        self.layers: Dict[int, Dict[int, 'TraceEvent']]={}  # layer -> id(event) -> event, arrival order
+
+    def _node(self, k: int, n: int):
+        if k not in self.own:
+            self.own[k]=[]; self.evs[k]=[]; self.lay[k]=[]
+            self.col[k]={j:[] for j in range(1, n+1)}
+        for j in range(len(self.col[k])+1, n+1):  # a longer vector than seen so far
+            self.col[k][j]=[0]*len(self.own[k])
+
+    def _set(self, k: int, i: int, layer: int):
+        ev=self.evs[k][i]; old=self.lay[k][i]
+        if old: del self.layers[old][id(ev)]
+        self.lay[k][i]=layer
+        self.layers.setdefault(layer, {})[id(ev)]=ev
+
+    def add(self, ev: 'TraceEvent') -> int:
+        """Place one event; returns its layer."""
+        home=k=ev.node; vec=ev.vector; n=len(vec); c=vec[k-1]
+        self._node(k, n)
+        depth=0
+        for j,own in self.own.items():
+            i=(bisect.bisect_left(own, c) if j==k else bisect.bisect_right(own, vec[j-1] if j<=n else 0))-1
+            if i>=0 and self.lay[j][i]>depth: depth=self.lay[j][i]
+        pos=bisect.bisect_right(self.own[k], c)
+        self.own[k].insert(pos, c); self.evs[k].insert(pos, ev); self.lay[k].insert(pos, 0)
+        for j,col in self.col[k].items(): col.insert(pos, vec[j-1] if j<=n else 0)
+        self._set(k, pos, depth+1)
+        work=[(k, pos)]
+        while work:
+            k,i=work.pop()
+            c=self.own[k][i]; need=self.lay[k][i]+1
+            for m,own in self.own.items():
+                if m==k: t=bisect.bisect_right(own, c)
+                elif k in self.col[m]: t=bisect.bisect_left(self.col[m][k], c)
+                else: continue
+                lay=self.lay[m]
+                while t<len(lay) and lay[t]<need:
+                    self._set(m, t, need); work.append((m, t)); t+=1
+        return self.lay[home][pos]
+
+    def remove(self, ev: 'TraceEvent'):
+        """Forget an evicted event. Layers of the remaining events are kept as they are."""
+        k=ev.node; own=self.own.get(k)
+        if not own: return
+        i=bisect.bisect_left(own, ev.vector[k-1])
+        while i<len(own) and self.evs[k][i] is not ev: i+=1
+        if i==len(own): return
+        bucket=self.layers[self.lay[k][i]]; del bucket[id(ev)]
+        if not bucket: del self.layers[self.lay[k][i]]
+        del own[i], self.evs[k][i], self.lay[k][i]
+        for col in self.col[k].values(): del col[i]
+
+    def layer_of(self, ev: 'TraceEvent') -> int:
+        own=self.own[ev.node]; i=bisect.bisect_left(own, ev.vector[ev.node-1])
+        while self.evs[ev.node][i] is not ev: i+=1
+        return self.lay[ev.node][i]
+
+    def layered(self) -> List[List['TraceEvent']]:
+        return [list(self.layers[l].values()) for l in sorted(self.layers)]
+
+class TraceEvent:
+    """One logged event. `seq` is the logger's arrival number, `rx` its arrival time."""
+    __slots__=('seq','rx','node','stage','op','phy_ts','lamport','vector')
+    def __init__(self, seq: int, rx: float, d: Dict):
+        self.seq=seq; self.rx=rx
+        self.node=int(d['node']); self.stage=d['stage']; self.op=d['op']
+        self.phy_ts=float(d['phy_ts']); self.lamport=int(d['lamport']); self.vector=tuple(d['vector'])
+    def to_dict(self) -> Dict:
+        return {'seq':self.seq,'node':self.node,'stage':self.stage,'op':self.op,
+                'phy_ts':self.phy_ts,'lamport':self.lamport,'vector':list(self.vector)}
+
 class Logger:
-    """Collects events from nodes and prints orders by physical, Lamport, Vector."""
-    def __init__(self, tcp_port: int, numnodes: int, interval: float=3.0):
+    """
+    Collects events from nodes and prints orders by physical, Lamport, Vector.
+    Only the newest `max_events` events (and none older than `max_age`
+    seconds, if set) are kept. Each tick prints just the events that arrived
+    since the previous one; older ones are fetched with `TRACE <from_seq> [count]`.
+    """
+    def __init__(self, tcp_port: int, numnodes: int, interval: float=3.0, engine: str='thread',
+                 max_events: int=100000, max_age: float=0.0):
         self.tcp_port=tcp_port
         self.n=numnodes
-        self.events: List[Dict] = []
+        self.events: 'collections.deque[TraceEvent]'=collections.deque()
+        self.order=CausalIndex()
         self.lock=threading.Lock()
         self.interval=interval
+        self.engine=engine
+        self.max_events=max_events; self.max_age=max_age
+        self.next_seq=0; self.printed=0
 
     def serve(self):
         threading.Thread(target=self._printer, daemon=True).start()
+        if self.engine=='asyncio':
+            asyncio.run(self._serve_async()); return
         srv=socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         srv.bind(('0.0.0.0', self.tcp_port)); srv.listen(128)
@@ -40,180 +277,1380 @@ class Logger:
             conn,_=srv.accept()
             threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
 
+    def _ingest(self, line: bytes) -> Optional[bytes]:
+        """Store one JSON event line, or answer a TRACE query line."""
+        line=line.strip()
+        if not line: return None
+        if line.startswith(b'TRACE'):
+            return self._query(line.decode().split()[1:])
+        try: ev=json.loads(line)
+        except ValueError: return None
+        now=time.monotonic()
+        with self.lock:
+            e=TraceEvent(self.next_seq, now, ev); self.next_seq+=1
+            self.events.append(e)
+            self.order.add(e)
+            self._evict(now)
+        return None
+
+    def _evict(self, now: float):
+        evs=self.events
+        while evs and (len(evs)>self.max_events or (self.max_age and now-evs[0].rx>self.max_age)):
+            self.order.remove(evs.popleft())
+
+    def _query(self, args: List[str]) -> bytes:
+        """TRACE <from_seq> [count] -> one JSON line with the retained events in that window."""
+        try:
+            start=int(args[0]) if args else 0; count=int(args[1]) if len(args)>1 else 1000
+        except ValueError:
+            return b'{"error":"usage: TRACE <from_seq> [count]"}\n'
+        with self.lock:
+            first=self.events[0].seq if self.events else self.next_seq
+            i=max(0, start-first)
+            out=[]
+            for j in range(i, min(len(self.events), i+count)):
+                e=self.events[j]; d=e.to_dict(); d['layer']=self.order.layer_of(e); out.append(d)
+            nxt=out[-1]['seq']+1 if out else max(start, first)
+            return (json.dumps({'first':first,'next':nxt,'events':out})+'\n').encode()
+
     def _handle(self, conn: socket.socket):
+        # One JSON event per line; nodes keep the connection open and stream batches.
         try:
-            raw=recv_all(conn)
-            if not raw: return
-            ev=json.loads(raw)
-            with self.lock:
-                self.events.append(ev)
+            with conn.makefile('rb') as f:
+                for line in f:
+                    reply=self._ingest(line)
+                    if reply: conn.sendall(reply)
         except Exception:
             pass
         finally:
             try: conn.close()
             except: pass
 
-    @staticmethod
-    def _vc_leq(a: List[int], b: List[int]) -> bool:
-        return all(x<=y for x,y in zip(a,b))
+    async def _serve_async(self):
+        srv=await asyncio.start_server(self._handle_async, '0.0.0.0', self.tcp_port, backlog=1024, reuse_address=True)
+        print(f"[LOGGER] listening on {self.tcp_port} (asyncio)")
+        async with srv:
+            await srv.serve_forever()
+
+    async def _handle_async(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                line=await reader.readline()
+                if not line: break
+                reply=self._ingest(line)
+                if reply:
+                    writer.write(reply); await writer.drain()
+        except Exception:
+            pass
+        finally:
+            writer.close()
 
     def _printer(self):
         while True:
             time.sleep(self.interval)
             with self.lock:
-                evs=list(self.events)
-            if not evs:
+                self._evict(time.monotonic())
+                new=[]
+                for e in reversed(self.events):
+                    if e.seq<self.printed: break
+                    new.append(e)
+                new.reverse()
+                layers={}
+                for e in new: layers.setdefault(self.order.layer_of(e), []).append(e)
+                total=len(self.events); self.printed=self.next_seq
+            if not new:
                 continue
-            phys=sorted(evs, key=lambda e:(e['phy_ts'], e['node'], e['lamport']))
-            lam =sorted(evs, key=lambda e:(e['lamport'], e['node']))
-
-            # Vector layers (set of incomparable events)
-            used=set(); layers: List[List[Dict]]=[]
-            while len(used)<len(evs):
-                layer=[]
-                for i,e in enumerate(evs):
-                    if i in used: continue
-                    before=False
-                    for j,o in enumerate(evs):
-                        if j in used or j==i: continue
-                        if self._vc_leq(o['vector'], e['vector']) and o['vector']!=e['vector']:
-                            before=True; break
-                    if not before: layer.append(e)
-                if not layer: break
-                layers.append(layer)
-                for e in layer: used.add(evs.index(e))
-
-            print("\n================ TRACE (last %d events) ================"%len(evs))
+            phys=sorted(new, key=lambda e:(e.phy_ts, e.node, e.lamport))
+            lam =sorted(new, key=lambda e:(e.lamport, e.node))
+
+            print("\n================ TRACE (%d new, seq %d-%d, %d retained) ================"%(len(new), new[0].seq, new[-1].seq, total))
             print("-- Physical order --")
             for e in phys:
-                print(f"t={e['phy_ts']:.6f} L={e['lamport']:>3} V={e['vector']} node={e['node']} {e['stage']} {e['op']}")
+                print(f"t={e.phy_ts:.6f} L={e.lamport:>3} V={list(e.vector)} node={e.node} {e.stage} {e.op}")
             print("-- Lamport order --")
             for e in lam:
-                print(f"L={e['lamport']:>3} t={e['phy_ts']:.6f} V={e['vector']} node={e['node']} {e['stage']} {e['op']}")
+                print(f"L={e.lamport:>3} t={e.phy_ts:.6f} V={list(e.vector)} node={e.node} {e.stage} {e.op}")
             print("-- Vector partial order (layers of concurrent sets) --")
-            for i,layer in enumerate(layers,1):
-                desc=", ".join([f"n{e['node']}:{e['stage']}:{e['op']}@{e['vector']}" for e in layer])
+            for i in sorted(layers):
+                desc=", ".join([f"n{e.node}:{e.stage}:{e.op}@{list(e.vector)}" for e in layers[i]])
                 print(f"Layer {i}: {desc}")
             print("======================================================\n")
 
 # ------------------------------- KV Node ---------------------------------
 
-class KV:
+class HLC:
+    """
+    Hybrid logical clock packed into one 64-bit int: wall-clock milliseconds
+    in the high 48 bits, a logical counter in the low 16. Stamps only grow,
+    stay close to real time, and order every write a node has seen before
+    its own, so comparing them means the same thing on every replica.
+    """
     def __init__(self):
-        self.store: Dict[str, Tuple[float,str]]={}
+        self.last=0; self.lock=threading.Lock()
+    def now(self) -> int:
+        pt=int(time.time()*1000)<<16
+        with self.lock:
+            self.last=pt if pt>self.last else self.last+1
+            return self.last
+    def update(self, ts: int):
+        """Fold in a stamp received from another node."""
+        pt=int(time.time()*1000)<<16
+        with self.lock:
+            m=max(self.last, ts)
+            self.last=pt if pt>m else m+1
+
+class WAL:
+    """
+    Append-only write-ahead log with group commit and snapshots, kept in
+    `path` as `wal.<gen>` segments plus one `snapshot` file.
+
+    Writers submit() records while holding their stripe lock, which keeps the
+    log in apply order, and then wait() outside it. A committer thread writes
+    everything queued so far with one write() and one fsync(), so concurrent
+    PUTs share the cost of a sync. A snapshot first switches to a new segment,
+    then dumps the store, then deletes the segments it covers. Recovery loads
+    the snapshot and replays the remaining segments in order. A record that
+    was cut short by a crash is detected by its CRC and ends the replay.
+    A failed write or fsync leaves the file in an unknown state, so it is
+    final: the error is kept in `error`, and every wait() from then on raises
+    it instead of reporting a write durable.
+    """
+    REC=struct.Struct('!IQHI')  # crc32 of the rest, HLC stamp, key length, value length
+
+    def __init__(self, path: str, fsync: bool=True):
+        self.path=path; self.fsync=fsync
+        os.makedirs(path, exist_ok=True)
+        self.cv=threading.Condition(); self.flock=threading.Lock()
+        self.buf: List[bytes]=[]; self.seq=0; self.durable=0
+        self.gen=0; self.f=None; self.size=0
+        self.commits=0; self.error: Optional[OSError]=None; self.max_ts=0
+
+    @classmethod
+    def encode(cls, k: str, ts: int, v: str) -> bytes:
+        kb=s2b(k); vb=s2b(v); tb=struct.pack('!Q', ts)
+        return cls.REC.pack(zlib.crc32(tb+kb+vb), ts, len(kb), len(vb))+kb+vb
+
+    @classmethod
+    def decode(cls, data: bytes):
+        """Yield (key, ts, value) records until the end or the first damaged record."""
+        off=0; hs=cls.REC.size
+        while off+hs<=len(data):
+            crc,ts,kl,vl=cls.REC.unpack_from(data, off); end=off+hs+kl+vl
+            if end>len(data) or zlib.crc32(data[off+4:off+12]+data[off+hs:end])!=crc: return
+            yield b2s(data[off+hs:off+hs+kl]), ts, b2s(data[off+hs+kl:end])
+            off=end
+
+    def _segments(self) -> List[int]:
+        return sorted(int(f[4:]) for f in os.listdir(self.path) if f.startswith('wal.') and f[4:].isdigit())
+
+    def _open(self, gen: int):
+        self.gen=gen; self.f=open(os.path.join(self.path, f"wal.{gen:08d}"), 'ab'); self.size=self.f.tell()
+
+    def recover(self, kv: 'KV') -> int:
+        """
+        Load the snapshot and replay the log into kv; returns records applied,
+        and leaves the greatest stamp seen in `max_ts`. Call before serving.
+        """
+        n=0; start=0; top=0
+        snap=os.path.join(self.path, 'snapshot')
+        if os.path.exists(snap):
+            with open(snap, 'rb') as f: data=f.read()
+            start=struct.unpack_from('!Q', data)[0]
+            for k,ts,v in self.decode(data[8:]): kv.load(k, ts, v); n+=1; top=max(top, ts)
+        segs=[g for g in self._segments() if g>=start]
+        for g in segs:
+            with open(os.path.join(self.path, f"wal.{g:08d}"), 'rb') as f:
+                for k,ts,v in self.decode(f.read()): kv.load(k, ts, v); n+=1; top=max(top, ts)
+        self.max_ts=top
+        self._open((segs[-1]+1) if segs else start)
+        threading.Thread(target=self._committer, daemon=True).start()
+        return n
+
+    def submit(self, rec: bytes) -> int:
+        with self.cv:
+            self.buf.append(rec); self.seq+=1
+            self.cv.notify_all()
+            return self.seq
+
+    def wait(self, seq: int):
+        with self.cv:
+            while self.durable<seq and not self.error: self.cv.wait()
+            if self.durable<seq: raise self.error
+
+    def _committer(self):
+        while True:
+            with self.cv:
+                while not self.buf: self.cv.wait()
+                buf=self.buf; self.buf=[]; last=self.seq
+                if self.error: continue
+            data=b''.join(buf)
+            try:
+                with self.flock:
+                    self.f.write(data); self.f.flush()
+                    if self.fsync: os.fsync(self.f.fileno())
+                    self.size+=len(data)
+            except (OSError, ValueError) as e:
+                print(f"[wal] commit to {self.path} failed, writes are no longer durable: {e}")
+                with self.cv:
+                    self.error=e if isinstance(e, OSError) else OSError(str(e)); self.cv.notify_all()
+                continue
+            with self.cv:
+                self.durable=last; self.commits+=1
+                self.cv.notify_all()
+
+    def snapshot(self, kv: 'KV'):
+        with self.flock:
+            self.f.close(); covered=self.gen+1; self._open(covered)
+        tmp=os.path.join(self.path, 'snapshot.tmp')
+        with open(tmp, 'wb') as f:
+            f.write(struct.pack('!Q', covered))
+            for items in kv.dump():
+                f.write(b''.join(self.encode(k, ts, v) for k,(ts,v) in items))
+            f.flush(); os.fsync(f.fileno())
+        os.replace(tmp, os.path.join(self.path, 'snapshot'))
+        for g in self._segments():
+            if g<covered: os.remove(os.path.join(self.path, f"wal.{g:08d}"))
+
+class KeyIndex:
+    """
+    Ordered set of the store's keys for prefix scans: sorted chunks of at most
+    2*CHUNK keys plus the last key of each chunk. A lookup bisects the chunk
+    maxima and then one chunk, an insert shifts at most one chunk, and a scan
+    starts at its first key instead of looking at every key.
+    """
+    CHUNK=512
+
+    def __init__(self):
+        self.chunks: List[List[str]]=[]; self.maxes: List[str]=[]
         self.lock=threading.Lock()
-    def put(self,k,v):
-        ts=time.monotonic()
+    def add(self, k: str):
+        self.add_many((k,))
+    def add_many(self, keys):
+        """Insert keys under one lock acquisition (a batch write adds many at once)."""
+        bl=bisect.bisect_left; half=self.CHUNK
         with self.lock:
-            cur=self.store.get(k)
-            if not cur or ts>=cur[0]:
-                self.store[k]=(ts,v)
-    def get(self,k)->str:
+            ch,mx=self.chunks,self.maxes
+            for k in keys:
+                if not ch:
+                    ch.append([k]); mx.append(k); continue
+                i=bl(mx, k)
+                if i==len(mx): i-=1
+                c=ch[i]; j=bl(c, k)
+                if j<len(c) and c[j]==k: continue
+                c.insert(j, k)
+                if j==len(c)-1: mx[i]=k
+                if len(c)>2*half:
+                    ch[i:i+1]=[c[:half], c[half:]]; mx[i:i+1]=[c[half-1], c[-1]]
+    def discard(self, k: str):
+        with self.lock:
+            ch,mx=self.chunks,self.maxes
+            i=bisect.bisect_left(mx, k)
+            if i==len(mx): return
+            c=ch[i]; j=bisect.bisect_left(c, k)
+            if j==len(c) or c[j]!=k: return
+            del c[j]
+            if not c: del ch[i]; del mx[i]
+            elif j==len(c): mx[i]=c[-1]
+    def scan(self, prefix: str, count: int, after: Optional[str]=None) -> List[str]:
+        """Up to count keys starting with prefix, in order, after the key `after` if given."""
+        out: List[str]=[]
         with self.lock:
-            return self.store.get(k,(0.0,'<nil>'))[1]
+            ch,mx=self.chunks,self.maxes
+            past=after is not None and after>=prefix
+            start=after if past else prefix; find=bisect.bisect_right if past else bisect.bisect_left
+            i=find(mx, start)
+            while i<len(ch) and len(out)<count:
+                c=ch[i]; j=find(c, start) if not out else 0
+                for k in c[j:j+count-len(out)]:
+                    if not k.startswith(prefix): return out
+                    out.append(k)
+                i+=1
+        return out
+
+class KV:
+    """
+    Last-writer-wins store keyed on (HLC stamp, value): of two versions of a
+    key the one with the greater stamp wins, ties broken by the value, so
+    replicas that see the same writes in any order end up identical, with or
+    without the mutex. Keys are spread over LEAVES buckets by CRC32 (the
+    same on every node) and the buckets are guarded by `shards` lock stripes
+    (bucket % shards). Multi-key operations take the stripes they touch in
+    ascending order, so they cannot deadlock with each other.
+
+    Each bucket keeps an XOR digest of hash(key, value) over its entries,
+    updated on every write, so the Merkle tree used by anti-entropy is built
+    from the bucket digests without reading the data. In ring mode the store
+    also keeps, per peer, bucket digests over just the keys it shares with
+    that peer (see scope()), maintained the same way. A KeyIndex keeps the
+    keys in order for SCAN.
+    With a WAL attached, writes return only once they are durable.
+    """
+    FANOUT=16; DEPTH=4; LEAVES=FANOUT**DEPTH
+
+    def __init__(self, shards: int=16, wal: Optional[WAL]=None):
+        self.n=max(1, shards)
+        self.buckets: Dict[int, Dict[str, Tuple[int,str]]]={}
+        self.digest: List[int]=[0]*self.LEAVES
+        self.locks=[threading.Lock() for _ in range(self.n)]
+        self.index=KeyIndex()
+        self.wal=wal
+        # scope(): (shared(key) -> peer ids, {peer: bucket digests}, tag), per leaf while it is being built
+        self.leaf_scope: List[Optional[Tuple]]=[None]*self.LEAVES; self.scoped: Optional[Tuple]=None
+    def _slot(self, k: str) -> Tuple[int,int]:
+        leaf=zlib.crc32(s2b(k))&(self.LEAVES-1)
+        return leaf, leaf%self.n
+    @staticmethod
+    def _h(k: str, v: str) -> int:
+        return int.from_bytes(hashlib.blake2b(s2b(k)+b'\0'+s2b(v), digest_size=8).digest(), 'big')
+    def _set(self, leaf: int, k: str, ts: int, v: str, cur):
+        """Install an entry; the caller holds the bucket's stripe lock and indexes a new key."""
+        b=self.buckets.get(leaf)
+        if b is None: b=self.buckets[leaf]={}
+        b[k]=(ts,v)
+        if cur is None: self._fold(leaf, k, self._h(k,v))
+        elif cur[1]!=v: self._fold(leaf, k, self._h(k,cur[1])^self._h(k,v))
+    def _fold(self, leaf: int, k: str, x: int):
+        """XOR a change into the bucket digest and into the scoped digests of the peers sharing k."""
+        self.digest[leaf]^=x
+        sc=self.leaf_scope[leaf]
+        if sc:
+            for p in sc[0](k):
+                d=sc[1].get(p)
+                if d is None: d=sc[1].setdefault(p, array.array('Q', bytes(8*self.LEAVES)))
+                d[leaf]^=x
+    def _cur(self, leaf: int, k: str):
+        b=self.buckets.get(leaf)
+        return b.get(k) if b else None
+    def put(self, k: str, v: str, ts: int, force: bool=False):
+        """LWW write; `force` installs the value whatever the stamps say (Raft applies in log order)."""
+        leaf,i=self._slot(k); seq=0
+        with self.locks[i]:
+            cur=self._cur(leaf,k)
+            if force or not cur or (ts,v)>cur:
+                self._set(leaf,k,ts,v,cur)
+                if cur is None: self.index.add(k)
+                if self.wal: seq=self.wal.submit(WAL.encode(k, ts, v))
+        if seq: self.wal.wait(seq)
+    def put_many(self, items: List[Tuple[str,int,str]]):
+        """Apply a batch of (key, ts, value) writes atomically with respect to other KV operations."""
+        seq=0; new=[]
+        by: Dict[int, List[Tuple[int,str,int,str]]]={}
+        for k,ts,v in items:
+            leaf,i=self._slot(k); by.setdefault(i, []).append((leaf,k,ts,v))
+        order=sorted(by)
+        for i in order: self.locks[i].acquire()
+        try:
+            for i in order:
+                for leaf,k,ts,v in by[i]:
+                    cur=self._cur(leaf,k)
+                    if not cur or (ts,v)>cur:
+                        self._set(leaf,k,ts,v,cur)
+                        if cur is None: new.append(k)
+                        if self.wal: seq=self.wal.submit(WAL.encode(k, ts, v))
+            if new: self.index.add_many(new)
+        finally:
+            for i in reversed(order): self.locks[i].release()
+        if seq: self.wal.wait(seq)
+    def load(self, k: str, ts: int, v: str):
+        """Install a recovered value without logging it again."""
+        leaf,i=self._slot(k)
+        with self.locks[i]:
+            cur=self._cur(leaf,k)
+            if not cur or (ts,v)>cur:
+                self._set(leaf,k,ts,v,cur)
+                if cur is None: self.index.add(k)
+    def dump(self):
+        """Yield a copy of each stripe's items, holding one stripe lock at a time."""
+        for i in range(self.n):
+            with self.locks[i]:
+                items=[it for leaf in range(i, self.LEAVES, self.n) if leaf in self.buckets for it in self.buckets[leaf].items()]
+            yield items
+    def get(self,k)->str:
+        leaf,i=self._slot(k)
+        with self.locks[i]:
+            cur=self._cur(leaf,k)
+        return cur[1] if cur else '<nil>'
+    def get_many(self, keys: List[str]) -> List[str]:
+        return [self.get(k) for k in keys]
+    def scan(self, prefix: str, count: int, after: Optional[str]=None, stamps: bool=False) -> Tuple[List[Tuple], Optional[str]]:
+        """
+        (key, value) of up to count keys with the prefix, in key order, after
+        `after`, and the cursor to resume from: the last key looked at, None
+        once the index has no more. A key removed meanwhile shortens the page
+        but does not end the scan. stamps=True gives (key, stamp, value).
+        """
+        out=[]; keys=self.index.scan(prefix, count, after)
+        for k in keys:
+            cur=self.getv(k)
+            if cur: out.append((k, cur[0], cur[1]) if stamps else (k, cur[1]))
+        return out, (keys[-1] if len(keys)==count else None)
+    def getv(self, k: str) -> Optional[Tuple[int,str]]:
+        """(stamp, value) of a key, or None."""
+        leaf,i=self._slot(k)
+        with self.locks[i]:
+            return self._cur(leaf,k)
+    def scope(self, shared, tag=None):
+        """
+        Start keeping scoped digests: shared(key) gives the peers a key is
+        shared with. Built one bucket at a time under its stripe lock, and from
+        then on kept current by every write; scoped_tree() answers for `tag`
+        once the whole store is covered. Called again when the ring changes.
+        """
+        self.scoped=None; sc=(shared, {}, tag)
+        for leaf in range(self.LEAVES):
+            with self.locks[leaf%self.n]:
+                b=self.buckets.get(leaf)
+                self.leaf_scope[leaf]=sc
+                if b:
+                    for k,(_ts,v) in b.items():
+                        for p in shared(k):
+                            d=sc[1].get(p)
+                            if d is None: d=sc[1].setdefault(p, array.array('Q', bytes(8*self.LEAVES)))
+                            d[leaf]^=self._h(k,v)
+        self.scoped=sc
+    def scoped_tree(self, peer: int, tag=None) -> Optional[List[List[int]]]:
+        """Merkle levels over the keys shared with peer, or None while scope(.., tag) is not complete."""
+        sc=self.scoped
+        if sc is None or sc[2] is not tag: return None
+        d=sc[1].get(peer)
+        return self.tree(list(d) if d is not None else [0]*self.LEAVES)
+    def tree(self, lvl: Optional[List[int]]=None) -> List[List[int]]:
+        """Merkle levels from the root (level 0) down to the bucket digests (level DEPTH)."""
+        if lvl is None: lvl=list(self.digest)
+        levels=[lvl]; f=self.FANOUT
+        while len(lvl)>1:
+            lvl=[functools.reduce(operator.xor, lvl[j:j+f]) for j in range(0, len(lvl), f)]
+            levels.append(lvl)
+        return levels[::-1]
+    def drop(self, items: List[Tuple[str,int]]) -> int:
+        """Remove keys still at the given stamp (a newer write keeps the key); not logged to the WAL."""
+        n=0
+        for k,ts in items:
+            leaf,i=self._slot(k)
+            with self.locks[i]:
+                cur=self._cur(leaf,k)
+                if not cur or cur[0]!=ts: continue
+                b=self.buckets[leaf]; del b[k]; self._fold(leaf, k, self._h(k,cur[1])); self.index.discard(k); n+=1
+                if not b: del self.buckets[leaf]
+        return n
+    def leaf_items(self, leaves: List[int], keep=None) -> List[Tuple[str,int,str]]:
+        out=[]
+        for leaf in leaves:
+            with self.locks[leaf%self.n]:
+                b=self.buckets.get(leaf)
+                if b: out.extend((k,ts,v) for k,(ts,v) in b.items() if keep is None or keep(k))
+        return out
+
+class EventShipper:
+    """
+    Ships trace events to the Logger off the request path. Events go into a
+    bounded ring buffer; a flusher thread sends them as newline-delimited
+    batches over one persistent connection. When the buffer is full the
+    'drop' policy discards the oldest event and 'block' makes the caller wait.
+    Events that cannot be delivered (logger down or too slow) are dropped.
+    """
+    def __init__(self, addr: Tuple[str,int], capacity: int=10000, policy: str='drop',
+                 batch: int=512, flush_ms: float=50.0, timeout: float=1.0):
+        self.addr=addr; self.capacity=capacity; self.policy=policy
+        self.batch=batch; self.flush=flush_ms/1000.0; self.timeout=timeout
+        self.buf: 'collections.deque[Dict]'=collections.deque()
+        self.cv=threading.Condition()
+        self.shipped=0; self.dropped=0
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def emit(self, ev: Dict):
+        with self.cv:
+            if len(self.buf)>=self.capacity:
+                if self.policy=='drop':
+                    self.buf.popleft(); self.dropped+=1
+                else:
+                    while len(self.buf)>=self.capacity: self.cv.wait()
+            self.buf.append(ev)
+            if len(self.buf)>=self.batch: self.cv.notify_all()
+
+    def _run(self):
+        sock: Optional[socket.socket]=None
+        while True:
+            with self.cv:
+                if len(self.buf)<self.batch: self.cv.wait(self.flush)
+                evs=[self.buf.popleft() for _ in range(min(self.batch, len(self.buf)))]
+                self.cv.notify_all()
+            if not evs: continue
+            data=''.join(json.dumps(e)+'\n' for e in evs).encode()
+            try:
+                if sock is None:
+                    sock=socket.create_connection(self.addr, timeout=self.timeout)
+                sock.sendall(data); self.shipped+=len(evs)
+            except OSError:
+                self.dropped+=len(evs)
+                if sock:
+                    try: sock.close()
+                    except: pass
+                sock=None
+                time.sleep(self.flush)
+
+# Gossip datagrams are binary: GOSSIP_HDR (magic, kind, sender id, sender
+# incarnation, membership digest, probe seq, probe target, entry count) followed
+# by that many GOSSIP_ENT records (id, incarnation, state, host length, tcp
+# port, udp port) each trailed by the host. Every datagram piggybacks the
+# entries that changed in the last few rounds; a receiver whose digest differs
+# answers with SYNC and gets back a FULL table.
+GOSSIP_MAGIC=b'KVG2'
+GOSSIP_HDR=struct.Struct('!4sBIQIIIH')
+GOSSIP_ENT=struct.Struct('!IQBBHH')
+G_PING, G_ACK, G_PING_REQ, G_SYNC, G_FULL = 0, 1, 2, 3, 4
+STATES=(STATE_ALIVE, STATE_SUSPECT, STATE_DEAD)
+LOOPBACK=('127.0.0.1', 'localhost', None)
 
 class Gossip:
     """
     peers_map: List[(host, tcp, udp, id)]
-    Sends gossip to each peer's UDP (critical fix).
+    SWIM failure detector. Each protocol period one member (round robin over
+    a shuffled list) is PINGed; without an ACK after `ping_timeout` the probe
+    goes through `k` other members as PING_REQ, and if the period ends with no
+    ACK either way the member becomes SUSPECT. A suspect that does not refute
+    within `suspect_timeout` becomes DEAD. Members refute by bumping their
+    incarnation: ALIVE(i) beats SUSPECT(j) when i>j, SUSPECT(i) beats ALIVE(i),
+    DEAD(i) beats both when i>=j. Incarnations start at the wall clock in ms,
+    so a restarted node outranks whatever the cluster remembers of it.
+    The table is guarded by `lock`. Hot-path readers get copy-on-write
+    snapshots instead: `alive` (sorted ALIVE ids, so leader() is O(1)) and
+    `tcp_of` (id -> TCP address).
+    With engine='asyncio' no threads are started; the owner calls serve_async()
+    on its event loop instead.
     """
-    def __init__(self, node_id:int, udp_port:int, peers_map:List[Tuple[str,int,int,int]]):
+    MAX_PIGGY=64
+
+    def __init__(self, node_id:int, udp_port:int, peers_map:List[Tuple[str,int,int,int]], engine:str='thread',
+                 period: float=0.5, k: int=3, suspect_mult: float=4.0):
         self.id=node_id; self.udp_port=udp_port
-        self.table: Dict[int, Dict]= {
-            self.id:{'state':STATE_ALIVE,'hb':0,'last':time.monotonic(),'addr':('127.0.0.1',None)}
-        }
+        self.period=period; self.ping_timeout=period/4; self.k=k; self.suspect_mult=suspect_mult
+        self.round=0; self.digest=0; self.sync_asked: Dict[int,float]={}
+        self.seq=0; self.probe: Optional[Dict]=None; self.order: List[int]=[]
+        self.relay: Dict[int, Tuple[Tuple[str,int], int, float]]={}
+        self.on_change=None  # optional callback(nid, state)
+        self.lock=threading.RLock()
+        self.table: Dict[int, Dict]={}
+        self.alive: Tuple[int,...]=(); self.tcp_of: Dict[int, Tuple[str,int]]={}
+        now=time.monotonic()
+        self._add(self.id, STATE_ALIVE, int(time.time()*1000), ('127.0.0.1',None), None, now)
         for h,tcp,udp,nid in peers_map:
-            self.table[nid]={'state':STATE_SUSPECT,'hb':0,'last':time.monotonic(),'addr':(h,tcp)}
+            if nid==self.id: self.table[nid]['addr']=(h,tcp); self.table[nid]['udp']=(h,udp); self._set_addr(nid, (h,tcp))
+            else: self._add(nid, STATE_SUSPECT, 0, (h,tcp), (h,udp), now)
         self.peers_map=peers_map
+        self.piggy=(0, b''); self.sent_bytes=0
         self.sock=socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
         self.sock.bind(('0.0.0.0',udp_port))
-        threading.Thread(target=self._rx,daemon=True).start()
-        threading.Thread(target=self._tx,daemon=True).start()
+        self.transport: Optional[asyncio.DatagramTransport]=None
+        if engine=='thread':
+            threading.Thread(target=self._rx,daemon=True).start()
+            threading.Thread(target=self._tx,daemon=True).start()
+
+    @property
+    def suspect_timeout(self) -> float:
+        return self.suspect_mult*max(1.0, math.log10(len(self.table)))*self.period
+
+    def _add(self, nid: int, state: str, inc: int, addr: Tuple, udp: Optional[Tuple], now: float) -> Dict:
+        """Insert a new entry; membership changes fold the id into the digest."""
+        self.digest^=zlib.crc32(nid.to_bytes(4,'big'))
+        inf=self.table[nid]={'state':state,'inc':inc,'since':now,'addr':addr,'udp':udp,'ver':self.round}
+        if addr[1]: self._set_addr(nid, addr)
+        if state==STATE_ALIVE: self._set_alive(nid, True)
+        return inf
+
+    def _set_alive(self, nid: int, alive: bool):
+        ids=set(self.alive)
+        if alive: ids.add(nid)
+        else: ids.discard(nid)
+        self.alive=tuple(sorted(ids))
+
+    def _set_addr(self, nid: int, addr: Tuple[str,int]):
+        tcp=dict(self.tcp_of); tcp[nid]=addr; self.tcp_of=tcp
+
+    def _set(self, nid: int, inf: Dict, state: str, inc: int, now: float):
+        was=inf['state']
+        inf['state']=state; inf['inc']=inc; inf['ver']=self.round
+        if state!=was:
+            inf['since']=now
+            if STATE_ALIVE in (state, was): self._set_alive(nid, state==STATE_ALIVE)
+            if self.on_change: self.on_change(nid, state)
+
+    def _apply(self, nid: int, inc: int, state: str, addr: Tuple, udp: Optional[Tuple], now: float, direct: bool=False):
+        """Merge one member claim using the SWIM precedence rules. `direct`: the
+        claim is the sender speaking for itself, so `udp` is the datagram's source."""
+        if nid==self.id:
+            me=self.table[nid]
+            if state!=STATE_ALIVE and inc>=me['inc']: self._set(nid, me, STATE_ALIVE, inc+1, now)  # refute
+            return
+        loc=self.table.get(nid)
+        if loc is None:
+            self._add(nid, state, inc, addr, udp, now); return
+        # a third party may only fill in a missing UDP address; only the member itself moves it
+        if udp and udp[1] and loc['udp']!=udp and (direct or not loc['udp']): loc['udp']=udp
+        # configured (or already learned) TCP addresses are authoritative; claims only fill gaps
+        if addr[1] and not loc['addr'][1]: loc['addr']=addr; self._set_addr(nid, addr)
+        cur,ci=loc['state'],loc['inc']
+        if ((state==STATE_ALIVE and inc>ci) or
+            (state==STATE_SUSPECT and (inc>ci or (inc==ci and cur==STATE_ALIVE))) or
+            (state==STATE_DEAD and inc>=ci and cur!=STATE_DEAD)):
+            self._set(nid, loc, state, inc, now)
+
+    async def serve_async(self):
+        """Run receive and the protocol period on the current event loop via a datagram endpoint."""
+        gossip=self
+        class _Proto(asyncio.DatagramProtocol):
+            def datagram_received(self, data, addr): gossip._on_datagram(data, addr)
+        self.sock.setblocking(False)
+        self.transport,_=await asyncio.get_running_loop().create_datagram_endpoint(_Proto, sock=self.sock)
+        while True:
+            self._round()
+            await asyncio.sleep(self.ping_timeout)
+            self._indirect()
+            await asyncio.sleep(self.period-self.ping_timeout)
+
+    def _send(self, data: bytes, addr: Tuple[str,int]):
+        try:
+            if self.transport: self.transport.sendto(data, addr)
+            else: self.sock.sendto(data, addr)
+            self.sent_bytes+=len(data)
+        except OSError:
+            pass
 
     def _rx(self):
         while True:
             try:
                 data,addr=self.sock.recvfrom(65535)
-                msg=json.loads(data.decode())
-                if msg.get('type')!='gossip': continue
-                sid=msg['from']; hb=msg.get('heartbeat',0)
-                now=time.monotonic()
-                self.table.setdefault(sid,{'state':STATE_SUSPECT,'hb':0,'last':now,'addr':(addr[0],None)})
-                s=self.table[sid]; s['state']=STATE_ALIVE; s['hb']=max(s['hb'],hb); s['last']=now
-                for nid_s,rec in msg.get('known',{}).items():
-                    nid=int(nid_s)
-                    if nid==self.id: continue
-                    self.table.setdefault(nid,{'state':STATE_SUSPECT,'hb':0,'last':now,'addr':tuple(rec.get('addr')) if rec.get('addr') else (None,None)})
-                    loc=self.table[nid]
-                    loc['hb']=max(loc['hb'], rec.get('hb',0))
-                    if rec.get('state')==STATE_DEAD: loc['state']=STATE_DEAD
-                    elif rec.get('state')==STATE_ALIVE and loc['state']!=STATE_DEAD: loc['state']=STATE_ALIVE
-                    if rec.get('addr'): loc['addr']=tuple(rec['addr'])
             except Exception:
-                pass
+                continue
+            self._on_datagram(data, addr)
+
+    @staticmethod
+    def _entry(nid: int, inf: Dict) -> bytes:
+        host,tcp=inf['addr']; udp=inf['udp'][1] if inf['udp'] else 0
+        hostb=(host or '').encode()
+        return GOSSIP_ENT.pack(nid, inf['inc'], STATES.index(inf['state']), len(hostb), tcp or 0, udp or 0)+hostb
+
+    def _msg(self, kind: int, seq: int=0, target: int=0, extra: List[int]=(), full: bool=False) -> bytes:
+        """Header + this round's piggybacked entries (or the whole table) + entries for `extra` ids."""
+        if full: n,body=len(self.table), b''.join(self._entry(i,inf) for i,inf in list(self.table.items()))
+        else: n,body=self.piggy
+        tail=b''.join(self._entry(i, self.table[i]) for i in extra)
+        return GOSSIP_HDR.pack(GOSSIP_MAGIC, kind, self.id, self.table[self.id]['inc'], self.digest,
+                               seq, target, n+len(extra))+body+tail
+
+    def _decode(self, data: bytes):
+        magic,kind,sid,inc,digest,seq,target,n=GOSSIP_HDR.unpack_from(data)
+        if magic!=GOSSIP_MAGIC: raise ValueError('not gossip')
+        off=GOSSIP_HDR.size; entries=[]
+        for _ in range(n):
+            nid,einc,st,hlen,tcp,udp=GOSSIP_ENT.unpack_from(data, off); off+=GOSSIP_ENT.size
+            host=data[off:off+hlen].decode() or None; off+=hlen
+            entries.append((nid, einc, STATES[st], (host, tcp or None), (host, udp) if udp else None))
+        return kind, sid, inc, digest, seq, target, entries
+
+    def _next_seq(self) -> int:
+        self.seq=(self.seq+1)&0xffffffff
+        return self.seq
+
+    def _on_datagram(self, data: bytes, addr):
+        try:
+            kind,sid,inc,digest,seq,target,entries=self._decode(data)
+        except Exception:
+            return
+        with self.lock:
+            now=time.monotonic()
+            for nid,einc,state,eaddr,eudp in entries:
+                if eaddr[0] in LOOPBACK and addr[0] not in LOOPBACK:
+                    # a loopback claim relayed from another host means the relayer's host
+                    eaddr=(addr[0], eaddr[1]); eudp=eudp and (addr[0], eudp[1])
+                self._apply(nid, einc, state, eaddr, eudp, now)
+            # the sender speaks for itself
+            self._apply(sid, inc, STATE_ALIVE, (addr[0],None), (addr[0],addr[1]), now, direct=True)
+            if kind==G_PING:
+                # tell a sender we do not think is alive, so it can refute
+                extra=[sid] if self.table[sid]['state']!=STATE_ALIVE else []
+                self._send(self._msg(G_ACK, seq, target, extra), addr)
+            elif kind==G_ACK:
+                rel=self.relay.pop(seq, None)
+                if rel: self._send(self._msg(G_ACK, rel[1], target), rel[0])
+                elif self.probe and self.probe['seq']==seq: self.probe['acked']=True
+            elif kind==G_PING_REQ:
+                inf=self.table.get(target)
+                if inf and inf['udp']:
+                    mine=self._next_seq(); self.relay[mine]=(addr, seq, now)
+                    self._send(self._msg(G_PING, mine, target), inf['udp'])
+            elif kind==G_SYNC:
+                self._send(self._msg(G_FULL, full=True), addr)
+            if digest!=self.digest and kind!=G_SYNC and now-self.sync_asked.get(sid,0.0)>2*self.period:
+                # membership views differ: ask the sender for its whole table
+                self.sync_asked[sid]=now
+                self._send(GOSSIP_HDR.pack(GOSSIP_MAGIC, G_SYNC, self.id, self.table[self.id]['inc'], self.digest, 0, 0, 0), addr)
 
     def _tx(self):
         while True:
-            time.sleep(0.5)
-            now=time.monotonic(); me=self.table[self.id]
-            me['hb']=me.get('hb',0)+1; me['last']=now; me['state']=STATE_ALIVE
-            # suspicion / death
+            self._round()
+            time.sleep(self.ping_timeout)
+            self._indirect()
+            time.sleep(self.period-self.ping_timeout)
+
+    def _round(self):
+        """Close the previous probe, expire suspicions, then PING the next member."""
+        with self.lock:
+            now=time.monotonic(); p=self.probe
+            if p and not p['acked']:
+                inf=self.table[p['target']]
+                if inf['state']==STATE_ALIVE:
+                    self._set(p['target'], inf, STATE_SUSPECT, inf['inc'], now)
+                    # tell the suspect directly too, so a live one refutes without waiting for the rumor
+                    self._send(self._msg(G_PING, self._next_seq(), p['target'], [p['target']]), inf['udp'])
             for nid,inf in list(self.table.items()):
-                if nid==self.id: continue
-                age=now-inf['last']
-                if age>5.0: inf['state']=STATE_DEAD
-                elif age>2.0 and inf['state']==STATE_ALIVE: inf['state']=STATE_SUSPECT
-            msg={'type':'gossip','from':self.id,'heartbeat':me['hb'],'known':{str(n):{'state':inf['state'],'hb':inf['hb'],'addr':list(inf.get('addr',('127.0.0.1',None)))} for n,inf in self.table.items()}}
-            targets=random.sample(self.peers_map, k=min(2, len(self.peers_map))) if self.peers_map else []
-            for h,_tcp,peer_udp,_nid in targets:
-                try: self.sock.sendto(json.dumps(msg).encode(), (h, peer_udp))
-                except Exception: pass
+                # inc 0: a configured peer never heard from, which stays SUSPECT until it shows up
+                if inf['state']==STATE_SUSPECT and inf['inc'] and now-inf['since']>self.suspect_timeout:
+                    self._set(nid, inf, STATE_DEAD, inf['inc'], now)
+            self.relay={s:r for s,r in self.relay.items() if now-r[2]<self.period}
+            since=self.round-2*max(1, math.ceil(math.log2(len(self.table)+1)))
+            fresh=sorted(((inf['ver'],n) for n,inf in list(self.table.items()) if inf['ver']>since), reverse=True)[:self.MAX_PIGGY]
+            self.piggy=(len(fresh), b''.join(self._entry(n, self.table[n]) for _,n in fresh))
+            self.round+=1
+            self.probe=None
+            if not self.order:
+                self.order=[n for n in self.table if n!=self.id]; random.shuffle(self.order)
+            while self.order:
+                target=self.order.pop(); inf=self.table.get(target)
+                if inf and inf['udp']: break
+            else:
+                return
+            self.probe={'target':target,'seq':self._next_seq(),'acked':False}
+            # a member we suspect (or buried) learns it from the ping itself and can refute at once
+            extra=[target] if inf['state']!=STATE_ALIVE else []
+            self._send(self._msg(G_PING, self.probe['seq'], target, extra), inf['udp'])
+
+    def _indirect(self):
+        """Probe not acked yet: ask k other members to ping the target for us."""
+        with self.lock:
+            p=self.probe
+            if not p or p['acked'] or self.table[p['target']]['state']==STATE_DEAD: return
+            helpers=[n for n,inf in list(self.table.items())
+                     if n not in (self.id, p['target']) and inf['state']==STATE_ALIVE and inf['udp']]
+            for n in random.sample(helpers, min(self.k, len(helpers))):
+                self._send(self._msg(G_PING_REQ, p['seq'], p['target']), self.table[n]['udp'])
 
     def leader(self)->Optional[int]:
-        alive=[nid for nid,inf in self.table.items() if inf['state']==STATE_ALIVE]
-        return max(alive) if alive else None
+        alive=self.alive
+        return alive[-1] if alive else None
+
+    def alive_peers(self)->Tuple[int,...]:
+        return tuple(n for n in self.alive if n!=self.id)
 
     def addr_of(self,nid:int)->Optional[Tuple[str,int]]:
-        for h,tcp,_udp,i in self.peers_map:
-            if i==nid: return (h,tcp)
-        if nid==self.id:
-            for h,tcp,_udp,i in self.peers_map:
-                if i==self.id: return (h,tcp)
-        return None
+        return self.tcp_of.get(nid)
 
-class MutexCoordinator:
+class Ring:
+    """
+    Consistent-hash ring: each member gets `vnodes` points (blake2b of
+    "<id>#<i>"), a key hashes onto the ring and its replicas are the first
+    `rf` distinct members clockwise from it. Immutable; the node builds a
+    new one when membership changes. kvclient.py imports it.
+    """
+    def __init__(self, members, rf: int, vnodes: int=64):
+        self.members=tuple(sorted(members)); self.rf=min(rf, len(self.members)); self.vnodes=vnodes
+        pts=sorted((Ring.hash(f"{m}#{i}"), m) for m in self.members for i in range(vnodes))
+        self.points=[p for p,_ in pts]; self.owner=[m for _,m in pts]
+    @staticmethod
+    def hash(s: str) -> int:
+        return int.from_bytes(hashlib.blake2b(s2b(s), digest_size=8).digest(), 'big')
+    def owners(self, key: str) -> List[int]:
+        out: List[int]=[]; n=len(self.points)
+        i=bisect.bisect(self.points, Ring.hash(key))
+        while len(out)<self.rf:
+            m=self.owner[i%n]; i+=1
+            if m not in out: out.append(m)
+        return out
+
+REPL_BIN=b'REPL_BIN '
+
+class Replicator:
+    """
+    Replication stream to one peer: a bounded queue drained by a sender thread
+    that coalesces queued writes into REPL_BIN frames over the peer's
+    persistent MuxConn. A batch is flushed once it holds `batch` writes or its
+    first write is `flush_ms` old; up to `inflight` batches are pipelined.
+    The writes of one push (an MPUT) always travel in the same frame.
+
+    A REPL_BIN frame body is REPL_BIN, HDR (lamport, vector length, op count),
+    the vector as uint64s, then per write OP (HLC stamp, key length, value
+    length) followed by the key and value bytes. Values are never escaped, and
+    the receiver decodes each field straight out of the frame buffer.
+    """
+    HDR=struct.Struct('!QHI'); OP=struct.Struct('!QHI')
+    def __init__(self, node: 'Node', addr: Tuple[str,int], maxq: int=10000, batch: int=256,
+                 flush_ms: float=2.0, inflight: int=4):
+        self.node=node; self.addr=addr; self.batch=batch; self.flush=flush_ms/1000.0
+        self.q: 'queue.Queue[Tuple[List[Tuple[str,int,str]],int,List[int],Optional[Future]]]'=queue.Queue(maxq)
+        self.slots=threading.BoundedSemaphore(inflight)
+        self.sent=0; self.dropped=0; self.failed=0
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def push(self, ops: List[Tuple[str,int,str]], lam: int, vec: List[int], wait: bool=False) -> Optional[Future]:
+        """
+        Queue (key, ts, value) writes that go out in the same frame; with
+        wait=True return a future resolved once the peer acknowledged them.
+        """
+        fut: Optional[Future]=Future() if wait else None
+        try: self.q.put_nowait((ops, lam, vec, fut))
+        except queue.Full:
+            self.dropped+=len(ops)
+            if fut: fut.set_exception(queue.Full())
+        return fut
+
+    @classmethod
+    def encode(cls, lam: int, vec: List[int], ops: List[Tuple[str,int,str]]) -> bytes:
+        out=[REPL_BIN, cls.HDR.pack(lam, len(vec), len(ops)), struct.pack(f'!{len(vec)}Q', *vec)]
+        for k,ts,v in ops:
+            kb=s2b(k); vb=s2b(v); out+=(cls.OP.pack(ts, len(kb), len(vb)), kb, vb)
+        return b''.join(out)
+
+    @classmethod
+    def decode(cls, body) -> Tuple[int, List[int], List[Tuple[str,int,str]]]:
+        mv=memoryview(body); off=len(REPL_BIN); hs=cls.OP.size
+        lam,nv,count=cls.HDR.unpack_from(mv, off); off+=cls.HDR.size
+        vec=list(struct.unpack_from(f'!{nv}Q', mv, off)); off+=8*nv
+        ops=[]
+        for _ in range(count):
+            ts,kl,vl=cls.OP.unpack_from(mv, off); off+=hs
+            k=b2s(mv[off:off+kl]); off+=kl
+            ops.append((k, ts, b2s(mv[off:off+vl]))); off+=vl
+        return lam, vec, ops
+
+    def _run(self):
+        while True:
+            items=[self.q.get()]; n=len(items[0][0])
+            deadline=time.monotonic()+self.flush
+            while n<self.batch:
+                left=deadline-time.monotonic()
+                if left<=0: break
+                try: items.append(self.q.get(timeout=left)); n+=len(items[-1][0])
+                except queue.Empty: break
+            try:
+                self._send(items)
+            except Exception as e:  # never let one bad batch end the stream
+                self.failed+=n
+                for *_,f in items:
+                    if f and not f.done(): f.set_exception(e)
+
+    def _send(self, items):
+        # Clocks only grow, so the last entry's stamps cover the whole batch.
+        _ops,lam,vec,_f=items[-1]
+        ops=[op for it in items for op in it[0]]
+        futs=[f for *_,f in items if f]
+        self.slots.acquire()
+        try:
+            fut=self.node._peer(self.addr).submit(self.encode(lam, vec, ops))
+        except Exception as e:
+            self.slots.release(); self.failed+=len(ops)
+            for f in futs: f.set_exception(e)
+            return
+        def done(r: Future):
+            self.slots.release()
+            if r.exception() is None and r.result()=="OK": self.sent+=len(ops)
+            else: self.failed+=len(ops)
+            for f in futs:
+                if r.exception() is None: f.set_result(r.result())
+                else: f.set_exception(r.exception())
+        fut.add_done_callback(done)
+
+class Histogram:
+    """
+    Latency histogram in microseconds. Each power of two is split into 2**sub
+    linear buckets: sub=0 is plain log2 buckets, sub=5 knows a value to ~3%
+    at any scale in a few hundred buckets.
+    """
+    __slots__=('sub','counts','count','total','max')
+    def __init__(self, sub: int=0):
+        self.sub=sub; self.counts: Dict[int,int]={}; self.count=0; self.total=0.0; self.max=0.0
+    def _width(self, us: int) -> int: return 1<<max(0, us.bit_length()-1-self.sub)
+    def add(self, seconds: float):
+        us=seconds*1e6; u=max(1, int(us)); w=self._width(u); b=u//w*w
+        self.counts[b]=self.counts.get(b, 0)+1
+        self.count+=1; self.total+=us; self.max=max(self.max, us)
+    def merge(self, other: 'Histogram'):
+        for b,c in other.counts.items(): self.counts[b]=self.counts.get(b, 0)+c
+        self.count+=other.count; self.total+=other.total; self.max=max(self.max, other.max)
+    def quantile(self, q: float) -> float:
+        """Upper edge (us) of the bucket holding the q-quantile, capped at the max seen."""
+        want=q*self.count; seen=0
+        for b in sorted(self.counts):
+            seen+=self.counts[b]
+            if seen>=want: return min(float(b+self._width(b)), round(self.max, 1))
+        return 0.0
+    def summary(self, qs: Tuple[float, ...]=(0.5, 0.99)) -> Dict:
+        return {'count':self.count, 'mean_us':round(self.total/self.count, 1) if self.count else 0.0,
+                **{f"p{q*100:g}_us":self.quantile(q) for q in qs}, 'max_us':round(self.max, 1),
+                'buckets':{f"<{b+self._width(b)}us":c for b,c in sorted(self.counts.items())}}
+
+class _LockState:
+    __slots__=('cv','held_by','granted','expires','queue','live')
+    def __init__(self, lock: threading.Lock):
+        self.cv=threading.Condition(lock); self.held_by: Optional[int]=None
+        self.granted=0.0; self.expires=0.0
+        # FIFO of waiter tickets; a ticket leaves `live` when its waiter gives
+        # up and is skipped once it reaches the head, so nothing is removed
+        # from the middle of the queue.
+        self.queue: 'collections.deque[int]'=collections.deque(); self.live: set=set()
+    def head(self) -> Optional[int]:
+        q=self.queue
+        while q and q[0] not in self.live: q.popleft()
+        return q[0] if q else None
+
+class _NodeLockStats:
+    __slots__=('wait','hold','grants','timeouts','expired')
     def __init__(self):
-        self.lock=threading.Lock(); self.held_by: Optional[int]=None; self.queue: List[int]=[]
-    def req(self,nid:int)->bool:
+        self.wait=Histogram(); self.hold=Histogram(); self.grants=0; self.timeouts=0; self.expired=0
+
+class MutexCoordinator:
+    """
+    Lock service run by the leader, with an independent lock and FIFO queue
+    per name (a key, or any label a caller uses for a key range; '' is the
+    old cluster-wide lock). LOCK_REQ blocks on the coordinator until the lock
+    is granted (or the requester's wait runs out), so a release is handed to
+    the next waiter straight away instead of on its next poll. A grant is a
+    lease: if the holder neither releases it nor asks again (which renews
+    it) within `lease` seconds, it passes to the next waiter, so a crashed
+    holder cannot wedge the cluster.
+    A name written as a JSON list (["a","b"]) asks for all those locks at
+    once: they are taken in sorted order, so two such requests cannot
+    deadlock, and given back if any of them is not granted in time.
+    Per requesting node it records wait and hold times (see stats()).
+    """
+    def __init__(self, lease: float=2.0):
+        self.lock=threading.Lock(); self.names: Dict[str, _LockState]={}
+        self.lease=lease; self.tickets=itertools.count()
+        self.per_node: Dict[int, _NodeLockStats]={}
+    def _stats(self, nid: int) -> _NodeLockStats:
+        st=self.per_node.get(nid)
+        if st is None: st=self.per_node[nid]=_NodeLockStats()
+        return st
+    def _free(self, st: _LockState, now: float) -> bool:
+        if st.held_by is not None and now>=st.expires:
+            ns=self._stats(st.held_by); ns.expired+=1; ns.hold.add(st.expires-st.granted)
+            st.held_by=None
+        return st.held_by is None
+    @staticmethod
+    def _many(name: str) -> Optional[List[str]]:
+        if not (name.startswith('[') and name.endswith(']')): return None
+        try: names=json.loads(name)
+        except ValueError: return None
+        return sorted(set(names)) if isinstance(names, list) else None
+    def req(self, nid:int, name:str='', wait:float=0.0)->bool:
+        many=self._many(name)
+        if many is not None:
+            deadline=time.monotonic()+wait
+            for i,n in enumerate(many):
+                if not self.req(nid, n, max(0.0, deadline-time.monotonic())):
+                    for g in many[:i]: self.rel(nid, g)
+                    return False
+            return True
+        t0=now=time.monotonic(); deadline=now+wait
         with self.lock:
-            if self.held_by is None:
-                self.held_by=nid; return True
-            if nid not in self.queue: self.queue.append(nid)
-            return False
-    def rel(self,nid:int)->Optional[int]:
+            st=self.names.get(name)
+            if st is None: st=self.names[name]=_LockState(self.lock)
+            if st.held_by==nid and not self._free(st, now):
+                st.expires=now+self.lease; return True
+            me=next(self.tickets); st.queue.append(me); st.live.add(me)
+            try:
+                while True:
+                    if self._free(st, now) and st.head()==me:
+                        st.queue.popleft(); st.held_by=nid; st.granted=now; st.expires=now+self.lease
+                        ns=self._stats(nid); ns.grants+=1; ns.wait.add(now-t0)
+                        return True
+                    if now>=deadline:
+                        if wait: self._stats(nid).timeouts+=1
+                        return False
+                    left=deadline-now
+                    if st.held_by is not None: left=min(left, st.expires-now)
+                    st.cv.wait(left); now=time.monotonic()
+            finally:
+                st.live.discard(me); st.cv.notify_all()
+                if st.held_by is None and st.head() is None: del self.names[name]
+    def rel(self, nid:int, name:str='')->bool:
+        many=self._many(name)
+        if many is not None: return all([self.rel(nid, n) for n in many])
         with self.lock:
-            if self.held_by==nid:
-                self.held_by=None
-                if self.queue:
-                    nxt=self.queue.pop(0); self.held_by=nxt; return nxt
-        return None
+            st=self.names.get(name)
+            if st is None or st.held_by!=nid: return False
+            self._stats(nid).hold.add(time.monotonic()-st.granted)
+            st.held_by=None; st.cv.notify_all()
+            if st.head() is None: del self.names[name]
+            return True
+    def stats(self) -> Dict:
+        with self.lock:
+            return {'held':{n:st.held_by for n,st in self.names.items() if st.held_by is not None},
+                    'waiting':{n:len(st.live) for n,st in self.names.items() if st.live},
+                    'nodes':{str(nid):{'grants':ns.grants,'timeouts':ns.timeouts,'expired':ns.expired,
+                                       'wait':ns.wait.summary(),'hold':ns.hold.summary()}
+                             for nid,ns in self.per_node.items()}}
+
+class RaftStore:
+    """
+    Durable Raft state in `path`: term and vote in `raft.meta` (replaced
+    atomically), log entries appended to `raft.log` as CRC-checked records.
+    A truncation (a follower dropping a conflicting suffix) rewrites the log
+    file and bumps `gen`, so an append prepared before it is discarded.
+    """
+    REC=struct.Struct('!IQQHI')  # crc32 of the rest, term, HLC stamp, key length (0xffff: no-op), value length
+    META=struct.Struct('!Qq')
+
+    def __init__(self, path: str, fsync: bool=True):
+        self.path=path; self.fsync=fsync; self.lock=threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        self.gen=0; self.count=0
+        self.f=open(os.path.join(path, 'raft.log'), 'ab')
+
+    @classmethod
+    def encode(cls, e: Tuple) -> bytes:
+        term,k,ts,v=e
+        kb=b'' if k is None else s2b(k); vb=b'' if v is None else s2b(v)
+        rest=cls.REC.pack(0, term, ts, 0xffff if k is None else len(kb), len(vb))[4:]+kb+vb
+        return struct.pack('!I', zlib.crc32(rest))+rest
+
+    def load(self) -> Tuple[int, Optional[int], List[Tuple]]:
+        term,voted=0,None
+        try:
+            with open(os.path.join(self.path, 'raft.meta'), 'rb') as f:
+                term,v=self.META.unpack(f.read(self.META.size)); voted=None if v<0 else v
+        except (OSError, struct.error):
+            pass
+        with open(os.path.join(self.path, 'raft.log'), 'rb') as f: data=f.read()
+        entries=[]; off=0; hs=self.REC.size
+        while off+hs<=len(data):
+            crc,t,ts,kl,vl=self.REC.unpack_from(data, off); klen=0 if kl==0xffff else kl; end=off+hs+klen+vl
+            if end>len(data) or zlib.crc32(data[off+4:end])!=crc: break
+            k=None if kl==0xffff else b2s(data[off+hs:off+hs+klen])
+            entries.append((t, k, ts, None if k is None else b2s(data[off+hs+klen:end]))); off=end
+        if off<len(data):
+            self.f.truncate(off)  # torn tail from a crash
+        self.count=len(entries)
+        return term, voted, entries
+
+    def save_meta(self, term: int, voted: Optional[int]):
+        tmp=os.path.join(self.path, 'raft.meta.tmp')
+        with open(tmp, 'wb') as f:
+            f.write(self.META.pack(term, -1 if voted is None else voted)); f.flush()
+            if self.fsync: os.fsync(f.fileno())
+        os.replace(tmp, os.path.join(self.path, 'raft.meta'))
+
+    def append(self, first: int, entries: List[Tuple], gen: Optional[int]=None) -> bool:
+        """Write entries whose first index is `first`; False if the file moved on meanwhile."""
+        with self.lock:
+            if (gen is not None and gen!=self.gen) or first!=self.count+1: return False
+            self.f.write(b''.join(self.encode(e) for e in entries)); self.f.flush()
+            if self.fsync: os.fsync(self.f.fileno())
+            self.count+=len(entries)
+            return True
+
+    def truncate(self, entries: List[Tuple]):
+        """Rewrite the log file to hold exactly `entries` (indexes 1..n)."""
+        with self.lock:
+            self.gen+=1; self.f.close()
+            tmp=os.path.join(self.path, 'raft.log.tmp')
+            with open(tmp, 'wb') as f:
+                f.write(b''.join(self.encode(e) for e in entries)); f.flush()
+                if self.fsync: os.fsync(f.fileno())
+            os.replace(tmp, os.path.join(self.path, 'raft.log'))
+            self.f=open(os.path.join(self.path, 'raft.log'), 'ab'); self.count=len(entries)
+
+class Raft:
+    """
+    Replicated log for --replication raft. The leader appends each PUT as
+    (term, key, hlc, value), a per-peer thread ships AppendEntries batches of
+    up to `batch` entries with `inflight` of them pipelined, and an entry is
+    committed once a majority stores it. Every node applies committed entries
+    in log order to its KV store. Elections use randomized timeouts between
+    election_ms and twice that, and a node that heard from a leader within
+    election_ms refuses votes, which is what makes the leader's read lease
+    safe: after a majority acked an append sent at t, no other leader can
+    exist before t+election_ms (less a drift margin).
+    Membership is the static peer list. The log is never compacted.
+    """
+    def __init__(self, node: 'Node', peers: Dict[int, Tuple[str,int]], store: Optional[RaftStore]=None,
+                 election_ms: float=300, heartbeat_ms: float=50, batch: int=512, inflight: int=4):
+        self.node=node; self.id=node.id; self.peers=peers; self.store=store
+        self.election=election_ms/1000.0; self.heartbeat=heartbeat_ms/1000.0
+        self.batch=batch; self.inflight=inflight
+        self.majority=(len(peers)+1)//2+1
+        self.lock=threading.Lock(); self.cv=threading.Condition(self.lock)
+        self.term=0; self.voted: Optional[int]=None; self.log: List[Tuple]=[(0,None,0,None)]
+        if store: self.term,self.voted,entries=store.load(); self.log+=entries
+        self.node.hlc.update(max(e[2] for e in self.log))
+        self.flushed=len(self.log)-1
+        self.role='follower'; self.leader: Optional[int]=None
+        self.commit=0; self.applied=0; self.lead_start=0
+        self.waiters: Dict[int, Tuple[int, Future]]={}
+        self.heard=0.0; self.deadline=time.monotonic()+self._timeout()
+        self.next_idx: Dict[int,int]={}; self.match: Dict[int,int]={}; self.acked_at: Dict[int,float]={}
+        threading.Thread(target=self._ticker, daemon=True).start()
+        threading.Thread(target=self._applier, daemon=True).start()
+        if store: threading.Thread(target=self._flusher, daemon=True).start()
+        for p in peers: threading.Thread(target=self._replicate, args=(p,), daemon=True).start()
+
+    def _timeout(self) -> float:
+        return self.election*(1+random.random())
+
+    def _last(self) -> Tuple[int,int]:
+        return len(self.log)-1, self.log[-1][0]
+
+    def _observe(self, term: int):
+        """Step down to follower of a newer term (lock held)."""
+        if term>self.term:
+            self.term=term; self.voted=None; self.role='follower'; self.leader=None
+            if self.store: self.store.save_meta(term, None)
+            self.cv.notify_all()
+
+    # ------- client side -------
+    def propose(self, key: str, val: str) -> Optional[Future]:
+        """Append a PUT if we lead; the future resolves once it is applied here."""
+        with self.lock:
+            if self.role!='leader': return None
+            fut: Future=Future()
+            self.log.append((self.term, key, self.node.hlc.now(), val)); idx=len(self.log)-1
+            self.waiters[idx]=(self.term, fut)
+            if not self.store: self.flushed=idx; self._advance()
+            self.cv.notify_all()
+            return fut
+
+    def lease_ok(self) -> bool:
+        """Leader whose majority acked recently enough and that applied its own term's first entry."""
+        with self.lock:
+            if self.role!='leader' or self.applied<self.lead_start: return False
+            acks=sorted([time.monotonic()]+[self.acked_at.get(p,0.0) for p in self.peers], reverse=True)
+            return time.monotonic()<acks[self.majority-1]+self.election*0.9
+
+    def barrier(self, timeout: float) -> bool:
+        """Wait until lease_ok(), prompting the replicators to heartbeat now."""
+        end=time.monotonic()+timeout
+        while not self.lease_ok():
+            with self.cv:
+                if self.role!='leader' or time.monotonic()>=end: return False
+                self.cv.notify_all(); self.cv.wait(self.heartbeat)
+        return True
+
+    # ------- RPC handlers -------
+    def on_vote(self, m: Dict) -> Dict:
+        with self.lock:
+            now=time.monotonic()
+            if m['term']<self.term or self.role=='leader' or \
+               (self.leader is not None and self.leader!=m['cand'] and now-self.heard<self.election):
+                return {'term':self.term, 'granted':False}
+            self._observe(m['term'])
+            li,lt=self._last()
+            ok=self.voted in (None, m['cand']) and (m['last_term'],m['last_idx'])>=(lt,li)
+            if ok:
+                self.voted=m['cand']; self.deadline=now+self._timeout()
+                if self.store: self.store.save_meta(self.term, self.voted)
+            return {'term':self.term, 'granted':ok}
+
+    def on_append(self, m: Dict) -> Dict:
+        with self.lock:
+            if m['term']<self.term: return {'term':self.term, 'ok':False, 'hint':0}
+            self._observe(m['term'])
+            now=time.monotonic()
+            if self.role!='follower': self.role='follower'
+            self.leader=m['leader']; self.heard=now; self.deadline=now+self._timeout()
+            prev,entries=m['prev_idx'],m['entries']
+            if prev>=len(self.log): return {'term':self.term, 'ok':False, 'hint':len(self.log)}
+            if self.log[prev][0]!=m['prev_term']:
+                t=self.log[prev][0]; i=prev
+                while i>1 and self.log[i-1][0]==t: i-=1
+                return {'term':self.term, 'ok':False, 'hint':max(1, i)}
+            new=[]
+            for j,e in enumerate(entries):
+                i=prev+1+j; e=tuple(e)
+                if i<len(self.log):
+                    if self.log[i][0]==e[0]: continue
+                    del self.log[i:]
+                    if self.store: self.store.truncate(self.log[1:])
+                new=entries[j:]; self.log+=[tuple(x) for x in new]; break
+            if new and self.store: self.store.append(len(self.log)-len(new), [tuple(x) for x in new])
+            # keep our clock ahead of every stamp in the log, so our own proposals sort after them
+            if new: self.node.hlc.update(max(x[2] for x in new))
+            self.flushed=len(self.log)-1
+            match=prev+len(entries)
+            if m['commit']>self.commit:
+                self.commit=max(self.commit, min(m['commit'], match)); self.cv.notify_all()
+            return {'term':self.term, 'ok':True, 'match':match}
+
+    # ------- leader side -------
+    def _advance(self):
+        """Commit the highest index a majority holds, if it is from our term (lock held)."""
+        idx=sorted([self.flushed]+[self.match.get(p,0) for p in self.peers], reverse=True)[self.majority-1]
+        if idx>self.commit and self.log[idx][0]==self.term:
+            self.commit=idx; self.cv.notify_all()
+
+    def _campaign(self):
+        with self.lock:
+            self.term+=1; self.role='candidate'; self.voted=self.id; self.leader=None
+            if self.store: self.store.save_meta(self.term, self.id)
+            term=self.term; li,lt=self._last(); self.deadline=time.monotonic()+self._timeout()
+        req="RAFT_VOTE "+json.dumps({'term':term,'cand':self.id,'last_idx':li,'last_term':lt})
+        futs=[]
+        for addr in self.peers.values():
+            try: futs.append(self.node._peer(addr, self.election/2).submit(req))
+            except Exception: pass
+        votes=1; end=time.monotonic()+self.election
+        for f in futs:
+            try: r=json.loads(f.result(max(0.0, end-time.monotonic())))
+            except Exception: continue
+            with self.lock: self._observe(r['term'])
+            votes+=bool(r.get('granted'))
+        with self.lock:
+            if self.role!='candidate' or self.term!=term or votes<self.majority: return
+            self.role='leader'; self.leader=self.id
+            n=len(self.log)
+            self.next_idx={p:n for p in self.peers}; self.match={p:0 for p in self.peers}; self.acked_at={}
+            # a no-op from our term commits everything before it and gates lease reads
+            self.node.hlc.update(self.log[-1][2])
+            self.log.append((term, None, self.node.hlc.now(), None)); self.lead_start=len(self.log)-1
+            if not self.store: self.flushed=self.lead_start
+            self.cv.notify_all()
+        print(f"[node {self.id}] raft leader term={term}")
+        self.node._tick_local(); self.node._log('LEADER', f"{self.id}@{term}")
+
+    def _ticker(self):
+        while True:
+            time.sleep(self.heartbeat/2)
+            if self.role!='leader' and time.monotonic()>=self.deadline: self._campaign()
+
+    def _flusher(self):
+        """Leader group commit: persist new entries with one write and fsync, then count ourselves."""
+        while True:
+            with self.cv:
+                while not (self.role=='leader' and self.flushed<len(self.log)-1): self.cv.wait()
+                first=self.flushed+1; entries=self.log[first:]; gen=self.store.gen; term=self.term
+            ok=self.store.append(first, entries, gen)
+            with self.lock:
+                if ok and self.term==term and self.role=='leader':
+                    self.flushed=max(self.flushed, first+len(entries)-1); self._advance()
+
+    def _replicate(self, p: int):
+        slots=threading.BoundedSemaphore(self.inflight); last_sent=0.0
+        while True:
+            with self.cv:
+                while True:
+                    if self.role=='leader':
+                        if self.next_idx[p]<len(self.log): break
+                        if time.monotonic()-last_sent>=self.heartbeat: break
+                        self.cv.wait(self.heartbeat)
+                    else:
+                        self.cv.wait()
+                term=self.term; nxt=self.next_idx[p]
+                entries=self.log[nxt:nxt+self.batch]
+                msg={'term':term,'leader':self.id,'prev_idx':nxt-1,'prev_term':self.log[nxt-1][0],
+                     'entries':entries,'commit':self.commit}
+                self.next_idx[p]=nxt+len(entries)
+            slots.acquire(); sent=last_sent=time.monotonic()
+            try:
+                fut=self.node._peer(self.peers[p], self.election/2).submit("RAFT_APPEND "+json.dumps(msg))
+            except Exception:
+                slots.release()
+                with self.lock:
+                    if self.term==term: self.next_idx[p]=self.match[p]+1
+                time.sleep(self.heartbeat); continue
+            fut.add_done_callback(functools.partial(self._on_append_reply, p, term, sent, slots))
+
+    def _on_append_reply(self, p: int, term: int, sent: float, slots: threading.BoundedSemaphore, fut: Future):
+        slots.release()
+        with self.lock:
+            try: r=json.loads(fut.result())
+            except Exception:
+                if self.term==term and self.role=='leader': self.next_idx[p]=self.match[p]+1
+                return
+            self._observe(r['term'])
+            if self.term!=term or self.role!='leader': return
+            self.acked_at[p]=max(self.acked_at.get(p,0.0), sent)
+            if r['ok']:
+                self.match[p]=max(self.match[p], r['match']); self._advance()
+            else:
+                self.next_idx[p]=max(self.match[p]+1, min(self.next_idx[p], r['hint']))
+            self.cv.notify_all()
+
+    def _applier(self):
+        while True:
+            with self.cv:
+                while self.applied>=self.commit: self.cv.wait()
+                first=self.applied+1; entries=self.log[first:self.commit+1]
+            for i,(term,k,ts,v) in enumerate(entries, first):
+                if k is not None:
+                    # log order is the order of writes, whatever the stamps say
+                    self.node.kv.put(k, v, ts, force=True); self.node.hlc.update(ts)
+                    self.node._tick_local(); self.node._log('RAFT_APPLY', f"{k}={trace_value(v)}")
+            with self.lock:
+                self.applied=first+len(entries)-1
+                for i,(term,*_rest) in enumerate(entries, first):
+                    w=self.waiters.pop(i, None)
+                    if w: (w[1].set_result(True) if w[0]==term else w[1].set_exception(RuntimeError('entry overwritten')))
+                self.cv.notify_all()
 
 class Node:
     def __init__(self, node_id:int, tcp_port:int, udp_port:int, peers_map:List[Tuple[str,int,int,int]],
-                 logger_addr:Tuple[str,int], numnodes:int, use_mutex:bool):
-        self.id=node_id; self.tcp_port=tcp_port; self.use_mutex=use_mutex
+                 logger_addr:Tuple[str,int], numnodes:int, use_mutex:bool, engine:str='thread',
+                 log_buffer:int=10000, log_policy:str='drop', shards:int=16,
+                 data_dir:Optional[str]=None, fsync:bool=True, snapshot_mb:float=64.0,
+                 ae_interval:float=5.0, lock_lease:float=2.0,
+                 gossip_period:float=0.5, swim_k:int=3, suspect_mult:float=4.0,
+                 replication:str='broadcast', raft_election_ms:float=300, rf:int=0, vnodes:int=64):
+        self.id=node_id; self.tcp_port=tcp_port; self.use_mutex=use_mutex; self.engine=engine
         # Ensure self is present with its UDP and TCP
         if not any(i==node_id for *_, i in peers_map):
             peers_map=[('127.0.0.1', tcp_port, udp_port, node_id)] + peers_map
-        self.gossip=Gossip(node_id, udp_port, peers_map)
-        self.coord=MutexCoordinator()
-        self.kv=KV()
+        self.gossip=Gossip(node_id, udp_port, peers_map, engine, gossip_period, swim_k, suspect_mult)
+        self.coord=MutexCoordinator(lock_lease)
+        self.lock_wait=1.0; self.quorum_wait=1.0; self.read_repairs=0; self.local_mutex=[threading.Lock() for _ in range(64)]
+        # Elected leader: (term, id) only moves forward; a new leader grants
+        # no lock until lock_lease has passed, so grants of the old one expire.
+        self.term=0; self.leader: Optional[int]=None; self.lead_grace=0.0
+        self.elect_lock=threading.Lock(); self.electing=threading.Lock(); self.elect_after=0.0
+        self.wal=WAL(data_dir, fsync) if data_dir else None
+        self.hlc=HLC()
+        self.kv=KV(shards, self.wal)
+        if self.wal:
+            t0=time.perf_counter(); n=self.wal.recover(self.kv)
+            self.hlc.update(self.wal.max_ts)  # new writes must sort after everything recovered
+            print(f"[node {self.id}] recovered {n} records from {data_dir} in {time.perf_counter()-t0:.2f}s")
+            self.snapshot_bytes=int(snapshot_mb*1024*1024)
+            threading.Thread(target=self.snapshot_loop, daemon=True).start()
         self.logger_addr=logger_addr
+        self.events=EventShipper(logger_addr, log_buffer, log_policy)
         self.n=numnodes; self.idx = node_id-1  # expecting ids 1..n
         self.lamport=0
         self.vector=[0]*numnodes
-        threading.Thread(target=self.tcp_server,daemon=True).start()
+        self.conns: Dict[Tuple[str,int], MuxConn]={}; self.conns_lock=threading.Lock()
+        self.replicators: Dict[int, Replicator]={}
+        self.raft: Optional[Raft]=None; self.on_disk=bool(self.wal)
+        if replication=='raft':
+            store=RaftStore(os.path.join(data_dir, 'raft'), fsync) if data_dir else None; self.on_disk=bool(store)
+            self.raft=Raft(self, {i:(h,tcp) for h,tcp,_udp,i in peers_map if i!=node_id}, store, raft_election_ms)
+            self.SLOW_CMDS=Node.SLOW_CMDS|{'GET','MGET'}  # reads may wait for the lease or go to the leader
+        # Partitioning (--rf): keys live on ring.owners(key) only; others forward.
+        self.ring: Optional[Ring]=None; self.rf=rf; self.vnodes=vnodes
+        # in ring mode a pair of nodes only reconciles the ranges they share; rf=1 shares none
+        self.ae_scoped=rf>1 and ae_interval>0
+        if rf>0 and not self.raft:
+            self.ring=Ring(self.gossip.alive, rf, vnodes); self.ring_changed=threading.Event()
+            self.gossip.on_change=lambda _nid,_state: self.ring_changed.set()
+            self.ring_changed.set()  # members gossip found alive before the callback was in place
+            if self.ae_scoped: self.kv.scope(self._shared(self.ring), self.ring)
+            self.SLOW_CMDS=Node.SLOW_CMDS|{'GET','MGET','FWD'}
+            threading.Thread(target=self.ring_loop, daemon=True).start()
+        if engine=='asyncio':
+            # Blocking commands (PUT may wait on the leader mutex and peers, peer writes on the disk) run here.
+            self.pool=ThreadPoolExecutor(max_workers=64, thread_name_prefix=f"node{node_id}")
+            threading.Thread(target=lambda: asyncio.run(self.serve_async()),daemon=True).start()
+        else:
+            threading.Thread(target=self.tcp_server,daemon=True).start()
         threading.Thread(target=self.status_loop,daemon=True).start()
+        if not self.raft: threading.Thread(target=self.election_loop,daemon=True).start()
+        if ae_interval>0 and (not self.ring or self.ae_scoped):
+            threading.Thread(target=self.anti_entropy_loop, args=(ae_interval,), daemon=True).start()
         threading.Thread(target=self.interactive_loop, daemon=True).start()
 
     # ------- Clocks & logging -------
@@ -226,13 +1663,8 @@ class Node:
             self.vector[i]=max(self.vector[i], vec[i])
         self.vector[self.idx]+=1
     def _log(self, stage:str, op:str):
-        ev={'node': self.id, 'stage': stage, 'op': op,
-            'phy_ts': time.time(), 'lamport': self.lamport, 'vector': list(self.vector)}
-        try:
-            s=socket.create_connection(self.logger_addr, timeout=0.3)
-            s.sendall((json.dumps(ev)+'\n').encode()); s.close()
-        except Exception:
-            pass
+        self.events.emit({'node': self.id, 'stage': stage, 'op': op,
+                          'phy_ts': time.time(), 'lamport': self.lamport, 'vector': list(self.vector)})
 
     # ------- TCP server (client & RPCs) -------
     def tcp_server(self):
@@ -244,94 +1676,712 @@ class Node:
             conn,_=srv.accept()
             threading.Thread(target=self.handle_conn, args=(conn,), daemon=True).start()
 
+    # Commands that may wait on other nodes; on a multiplexed connection they
+    # run on their own thread so they don't hold up the requests behind them.
+    SLOW_CMDS={'PUT','MPUT','LOCK_REQ','AE_HASH','AE_LEAF'}
+    def _slow(self, raw: str) -> bool:
+        """Commands that may block on peers run off the connection's reader."""
+        if not isinstance(raw, str): return False
+        cmd=head(raw)
+        return cmd in self.SLOW_CMDS or (cmd=='GET' and quorum(raw) is not None)
+
+    # Peer writes that may wait on the disk (WAL group commit, Raft log). The
+    # thread engine runs them inline on the connection's reader, which keeps a
+    # peer's stream in order; the asyncio engine runs them in the pool, one at
+    # a time per connection, so the event loop never waits on an fsync.
+    DISK_CMDS={'REPL_PUT','REPL_BATCH','AE_PUSH','RAFT_APPEND','RAFT_VOTE'}
+    # Commands whose tail is one value or JSON body; dispatch splits off only their first two words.
+    BULK_CMDS={'PUT','FWD','REPL_PUT','REPL_BATCH','AE_PUSH','RAFT_APPEND','RAFT_VOTE'}
+    def _disk(self, raw) -> bool:
+        if not self.on_disk: return False
+        return not isinstance(raw, str) or head(raw) in self.DISK_CMDS
+
+
     def handle_conn(self, conn: socket.socket):
         try:
-            raw=recv_all(conn)
-            if not raw: conn.sendall(b"ERR\n"); return
-            parts=raw.split()
-            cmd=parts[0].upper()
-            if cmd=='GET' and len(parts)==2:
-                self._tick_local(); self._log('GET', parts[1])
-                conn.sendall((self.kv.get(parts[1])+'\n').encode()); return
-            if cmd=='PUT' and len(parts)>=3:
-                key, val = parts[1], " ".join(parts[2:])
-                self._do_put(key, val)
-                conn.sendall(b"OK\n"); return
-            if cmd=='REPL_PUT' and len(parts)>=5:
-                # REPL_PUT k v lam json_vector
-                key=parts[1]; val=parts[2]; rlam=int(parts[3]); rvec=json.loads(" ".join(parts[4:]))
-                self._merge_on_recv(rlam, rvec); self._log('REPL_RECV', f"{key}={val}")
-                self.kv.put(key,val)
-                conn.sendall(b"OK\n"); return
-            if cmd=='LOCK_REQ' and len(parts)==2:
-                nid=int(parts[1]); granted=self.coord.req(nid)
-                conn.sendall((b"GRANTED\n" if granted else b"QUEUED\n")); return
-            if cmd=='LOCK_REL' and len(parts)==2:
-                nid=int(parts[1]); self.coord.rel(nid); conn.sendall(b"OK\n"); return
-            conn.sendall(b"ERR\n")
+            head=recv_head(conn)
+            if head==MUX_MAGIC:
+                self._serve_mux(conn); return
+            raw=recv_all(conn, head)
+            try: resp=self.dispatch(raw)
+            except Exception: resp=b"ERR\n"  # e.g. the WAL could not make the write durable
+            conn.sendall(resp)
         finally:
             try: conn.close()
             except: pass
 
+    def _serve_mux(self, conn: socket.socket):
+        conn.settimeout(None)
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        wlock=threading.Lock()
+        def run(rid:int, raw:str):
+            try: resp=self.dispatch(raw)
+            except Exception: resp=b"ERR\n"
+            with wlock:
+                try: conn.sendall(FRAME.pack(len(resp), rid)+resp)
+                except OSError: pass
+        try:
+            while True:
+                hdr=recv_exact(conn, FRAME.size)
+                if not hdr: return
+                n,rid=FRAME.unpack(hdr); body=recv_exact(conn, n)
+                raw=body if body.startswith(REPL_BIN) else b2line(body)
+                if self._slow(raw):
+                    threading.Thread(target=run, args=(rid,raw), daemon=True).start()
+                else:
+                    run(rid, raw)
+        except OSError:
+            pass
+
+    # ------- asyncio server (--engine asyncio) -------
+    async def serve_async(self):
+        srv=await asyncio.start_server(self._handle_async, '0.0.0.0', self.tcp_port, backlog=4096, reuse_address=True)
+        print(f"[node {self.id}] TCP {self.tcp_port} | use_mutex={self.use_mutex} | engine=asyncio")
+        async with srv:
+            await asyncio.gather(srv.serve_forever(), self.gossip.serve_async())
+
+    async def _dispatch_async(self, raw: str, order: Optional[asyncio.Lock]=None) -> bytes:
+        loop=asyncio.get_running_loop()
+        if self._slow(raw):
+            return await loop.run_in_executor(self.pool, self.dispatch, raw)
+        if self._disk(raw):
+            if order is None: return await loop.run_in_executor(self.pool, self.dispatch, raw)
+            async with order:  # FIFO, so a peer's frames still apply in the order sent
+                return await loop.run_in_executor(self.pool, self.dispatch, raw)
+        return self.dispatch(raw)
+
+    async def _handle_async(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            head=await aread_head(reader)
+            if head==MUX_MAGIC:
+                await self._serve_mux_async(reader, writer); return
+            raw=await aread_all(reader, head)
+            try: resp=await self._dispatch_async(raw)
+            except Exception: resp=b"ERR\n"
+            writer.write(resp); await writer.drain()
+        except Exception:
+            pass
+        finally:
+            writer.close()
+
+    async def _serve_mux_async(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        sock=writer.get_extra_info('socket')
+        if sock: sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        order=asyncio.Lock()
+        async def run(rid:int, raw:str):
+            try: resp=await self._dispatch_async(raw, order)
+            except Exception: resp=b"ERR\n"
+            writer.write(FRAME.pack(len(resp), rid)+resp)
+        tasks=set()
+        while True:
+            try:
+                n,rid=FRAME.unpack(await reader.readexactly(FRAME.size))
+                body=await reader.readexactly(n)
+                raw=body if body.startswith(REPL_BIN) else b2line(body)
+            except (asyncio.IncompleteReadError, OSError):
+                return
+            t=asyncio.ensure_future(run(rid, raw)); tasks.add(t); t.add_done_callback(tasks.discard)
+            await writer.drain()
+
+    COMMANDS={'FWD','GET','PUT','MGET','MPUT','SCAN','SCANV','GETV','REPL_PUT','REPL_BATCH','AE_HASH','AE_LEAF','AE_PUSH',
+              'LOCK_REQ','LOCK_REL','LOCK_STATS','ELECT','COORD','LEADER','RAFT_APPEND','RAFT_VOTE','RING'}
+    def dispatch(self, raw: str, forwarded: bool=False) -> bytes:
+        """Execute one protocol command and return the reply line."""
+        if not raw: return b"ERR\n"
+        if not isinstance(raw, str): return self._repl_bin(raw)
+        # commands carrying a value or a JSON body are split at the head only,
+        # never token by token over the whole request
+        cmd=head(raw)
+        split=(lambda r: r.split(None,2)) if cmd in self.BULK_CMDS else str.split
+        parts=split(raw)
+        if cmd=='FWD' and len(parts)>=2:
+            # FWD <command>: sent by a node that does not own the key; never forwarded again
+            return self.dispatch(raw.split(None,1)[1], forwarded=True)
+        if self.ring and not forwarded and cmd in ('GET','PUT') and len(parts)>=2:
+            owners=self.ring.owners(parts[1])
+            if self.id not in owners: return self._forward(owners, raw)
+        level=0
+        if cmd in ('GET','PUT') and len(parts)>=3:
+            # PUT: parts[2] is the value with the suffix, which must leave a value behind
+            m=quorum(raw)
+            if m and m.group(1).upper()==('R' if cmd=='GET' else 'W') and (cmd=='GET' or m.start()>len(raw)-len(parts[2])):
+                level=int(m.group(2)); raw=raw[:m.start()]; parts=split(raw)
+        if cmd=='GET' and len(parts)==2:
+            if self.raft: return self._raft_get(parts[1])  # already linearizable
+            if level: return self._quorum_get(parts[1], level)
+            self._tick_local(); self._log('GET', parts[1])
+            return s2b(self.kv.get(parts[1])+'\n')
+        if cmd=='PUT' and len(parts)>=2:
+            # the value is everything after "PUT <key> ", whitespace and all
+            key=parts[1]; pre=f"{parts[0]} {key} "
+            if len(raw)>len(pre) and (len(parts)<3 or raw[len(pre)].isspace()) and raw.startswith(pre): val=raw[len(pre):]
+            elif len(parts)==3: val=parts[2]
+            else: return b"ERR\n"
+            if not key_ok(key): return b"ERR bad key\n"
+            if self.raft: return self._raft_put(key, val)
+            if level: return self._quorum_put(key, val, level)
+            self._do_put(key, val)
+            return b"OK\n"
+        if cmd=='MGET' and len(parts)>=2:
+            # MGET k1 k2 .. -> JSON list of the values, "<nil>" for absent keys
+            return self._mget(raw, parts[1:], forwarded)
+        if cmd=='MPUT' and len(parts)>=2:
+            # MPUT k1 v1 k2 v2 .., or MPUT {"k1":"v1",..} for values with spaces
+            body=raw.split(None,1)[1]
+            if body.startswith('{'):
+                try: items=list(json.loads(body).items())
+                except ValueError: return b"ERR\n"
+            elif len(parts)%2==1: items=list(zip(parts[1::2], parts[2::2]))
+            else: return b"ERR\n"
+            if not all(isinstance(v, str) for _k,v in items): return b"ERR\n"
+            if not all(key_ok(k) for k,_v in items): return b"ERR bad key\n"
+            return self._mput(raw, items, forwarded)
+        if cmd in ('SCAN','SCANV') and 3<=len(parts)<=4:
+            # SCAN <prefix|*> <count> [cursor] -> {"items":[[k,v],..],"cursor":..}; pass the cursor
+            # back for the next page, it is null once the scan is done. Covers this node's keys.
+            # SCANV returns [k,hlc,v] items, so a client merging replicas can keep the newest.
+            try: count=int(parts[2])
+            except ValueError: count=0
+            if count<1: return b"ERR bad count\n"
+            items,cursor=self.kv.scan('' if parts[1]=='*' else parts[1], count, parts[3] if len(parts)==4 else None,
+                                      stamps=cmd=='SCANV')
+            return (json.dumps({'items':items, 'cursor':cursor})+"\n").encode()
+        if cmd=='GETV' and len(parts)==2:
+            # GETV <key> -> "<hlc> <value>", "0 <nil>" if absent: a replica's answer to a quorum read
+            cur=self.kv.getv(parts[1])
+            return s2b(f"{cur[0]} {cur[1]}\n" if cur else "0 <nil>\n")
+        if cmd=='REPL_PUT' and len(parts)==3:
+            # REPL_PUT k v lam json_vector; the value may hold spaces, the vector is the trailing [..]
+            key=parts[1]; body=parts[2]; vi=body.rindex('[')
+            val,rlam=body[:vi].rstrip().rsplit(' ',1); rvec=json.loads(body[vi:])
+            self._merge_on_recv(int(rlam), rvec); self._log('REPL_RECV', f"{key}={trace_value(val)}")
+            self.kv.put(key, val, self.hlc.now())  # older nodes send no stamp
+            return b"OK\n"
+        if cmd=='REPL_BATCH' and len(parts)>=2:
+            # REPL_BATCH {"lam":..,"vec":[..],"ops":[[k,hlc,v],..]}, one clock merge per batch
+            b=json.loads(raw.split(None,1)[1]); ops=self._stamped(b['ops'])
+            self._merge_on_recv(b['lam'], b['vec'])
+            self._log('REPL_RECV', ", ".join(f"{k}={trace_value(v)}" for k,_ts,v in ops))
+            self.kv.put_many(ops)
+            return b"OK\n"
+        if cmd=='AE_HASH' and len(parts) in (3,4):
+            # AE_HASH <level> <i,j,..> [peer] -> Merkle hashes of those nodes, hex; with a peer
+            # (ring mode) the tree covers only the keys both nodes own
+            levels=self.kv.scoped_tree(int(parts[3]), self.ring) if len(parts)==4 else self.kv.tree()
+            if levels is None: return b"ERR\n"
+            lvl=levels[int(parts[1])]
+            return (" ".join(f"{lvl[int(i)]:016x}" for i in parts[2].split(','))+"\n").encode()
+        if cmd=='AE_LEAF' and len(parts) in (2,3):
+            # AE_LEAF <i,j,..> [peer] -> [[key, ts, value], ..] of those buckets
+            keep=self._ae_scope(int(parts[2])) if len(parts)==3 else None
+            return (json.dumps(self.kv.leaf_items([int(i) for i in parts[1].split(',')], keep))+"\n").encode()
+        if cmd=='AE_PUSH' and len(parts)>=2:
+            self.kv.put_many(self._stamped(json.loads(raw.split(None,1)[1])))
+            return b"OK\n"
+        if cmd=='LOCK_REQ' and 2<=len(parts)<=5:
+            # LOCK_REQ <nid> [<key> [wait_ms [term]]]: no key is the cluster-wide lock;
+            # without wait_ms answer at once, as older nodes expect. With a term,
+            # only the leader of exactly that term grants.
+            nid=int(parts[1]); name=parts[2] if len(parts)>2 else ''
+            wait=int(parts[3])/1000.0 if len(parts)>=4 else 0.0
+            if len(parts)==5 and (int(parts[4])!=self.term or self.leader!=self.id):
+                return f"STALE {self.term} {self.leader}\n".encode()
+            grace=self.lead_grace-time.monotonic()
+            if grace>0:
+                time.sleep(min(grace, wait))
+                if self.lead_grace>time.monotonic(): return b"QUEUED\n"
+            granted=self.coord.req(nid, name, wait)
+            return b"GRANTED\n" if granted else b"QUEUED\n"
+        if cmd=='ELECT' and len(parts)==3:
+            # ELECT <term> <id> from a lower node: point it at a live leader, or take over the election
+            leader=self.leader
+            if leader is not None and (leader==self.id or leader in self.gossip.alive):
+                return f"LEADER {self.term} {leader}\n".encode()
+            threading.Thread(target=self._elect, daemon=True).start()
+            return b"OK\n"
+        if cmd=='COORD' and len(parts)==3:
+            # COORD <term> <id>: a node proclaims itself leader of term
+            t,l=int(parts[1]),int(parts[2])
+            if self._adopt(t, l) or (t,l)==(self.term,self.leader): return b"ACK\n"
+            return f"STALE {self.term} {self.leader}\n".encode()
+        if cmd=='LEADER':
+            if self.raft: return f"LEADER {self.raft.term} {self.raft.leader}\n".encode()
+            return f"LEADER {self.term} {self.leader}\n".encode()
+        if cmd=='RAFT_APPEND' and self.raft:
+            return (json.dumps(self.raft.on_append(json.loads(raw.split(None,1)[1])))+"\n").encode()
+        if cmd=='RAFT_VOTE' and self.raft:
+            return (json.dumps(self.raft.on_vote(json.loads(raw.split(None,1)[1])))+"\n").encode()
+        if cmd=='RING':
+            ring=self.ring or Ring(self.gossip.alive, len(self.gossip.alive), self.vnodes)
+            return (json.dumps({'rf':ring.rf, 'vnodes':ring.vnodes, 'members':ring.members,
+                                'addrs':{n:self.gossip.addr_of(n) for n in ring.members}})+"\n").encode()
+        if cmd=='LOCK_STATS':
+            return (json.dumps(self.coord.stats())+"\n").encode()
+        if cmd=='LOCK_REL' and len(parts) in (2,3):
+            self.coord.rel(int(parts[1]), parts[2] if len(parts)==3 else ''); return b"OK\n"
+        # clients fall back to older commands (MPUT -> PUT) only on this exact reply
+        return b"ERR\n" if cmd in self.COMMANDS else b"ERR unknown command\n"
+
+    def _repl_bin(self, body) -> bytes:
+        """A REPL_BIN frame (see Replicator): one clock merge per batch, like REPL_BATCH."""
+        lam,vec,ops=Replicator.decode(body)
+        if ops: self.hlc.update(max(ts for _k,ts,_v in ops))
+        self._merge_on_recv(lam, vec)
+        self._log('REPL_RECV', ", ".join(f"{k}={trace_value(v)}" for k,_ts,v in ops))
+        self.kv.put_many(ops)
+        return b"OK\n"
+
+    def _stamped(self, ops: List[List]) -> List[Tuple[str,int,str]]:
+        """(key, hlc, value) writes from a peer; entries from older nodes ([key, value]) are stamped here."""
+        out=[(op[0],op[1],op[2]) if len(op)==3 else (op[0],self.hlc.now(),op[1]) for op in ops]
+        if out: self.hlc.update(max(ts for _k,ts,_v in out))
+        return out
+
+    def _peer(self, addr: Tuple[str,int], timeout: float=0.4) -> MuxConn:
+        """Cached multiplexed connection to another node, reopened if it dropped."""
+        with self.conns_lock:
+            c=self.conns.get(addr)
+            if c and not c.closed: return c
+        c=MuxConn(addr, timeout=timeout)
+        with self.conns_lock:
+            cur=self.conns.get(addr)
+            if cur and not cur.closed:
+                c.close(); return cur
+            self.conns[addr]=c
+        return c
+
     # ------- Local helpers (used by server & interactive) -------
     def _do_put(self, key: str, val: str):
-        if self.use_mutex:
+        if not self.use_mutex:
+            self._apply_put(key, val); return
+        # The coordinator knows nodes, not threads: one local writer per key asks at a time.
+        with self.local_mutex[zlib.crc32(s2b(key))%len(self.local_mutex)]:
             self._tick_local(); self._log('MUTEX_REQ', key)
-            self._acquire_mutex(); self._log('MUTEX_GOT', key)
-        self._tick_local(); self._log('APPLY_LOCAL', f"{key}={val}")
-        self.kv.put(key,val)
-        self._tick_local(); self._log('REPL_SEND', f"{key}={val}")
-        self._replicate_put(key,val)
-        if self.use_mutex:
-            self._tick_local(); self._release_mutex(); self._log('MUTEX_REL', key)
+            self._acquire_mutex(key); self._log('MUTEX_GOT', key)
+            try:
+                # Peers must hold this write before the next lock holder writes.
+                for f in self._apply_put(key, val, wait=True):
+                    try: f.result(0.4)
+                    except Exception: pass
+            finally:
+                self._tick_local(); self._release_mutex(key); self._log('MUTEX_REL', key)
+
+    def _apply_put(self, key: str, val: str, wait: bool=False) -> List[Future]:
+        ts=self.hlc.now()
+        self._tick_local(); self._log('APPLY_LOCAL', f"{key}={trace_value(val)}")
+        self.kv.put(key, val, ts)
+        self._tick_local(); self._log('REPL_SEND', f"{key}={trace_value(val)}")
+        return self._replicate([(key, ts, val)], wait)
+
+    def _do_put_many(self, items: List[Tuple[str,str]]):
+        """MPUT: one store batch, one replication batch per peer and, with the mutex, one lock request for all keys."""
+        if not self.use_mutex:
+            self._apply_many(items); return
+        keys=sorted({k for k,_v in items}); name=keys[0] if len(keys)==1 else json.dumps(keys, separators=(',',':'))
+        stripes=sorted({zlib.crc32(s2b(k))%len(self.local_mutex) for k in keys})
+        for i in stripes: self.local_mutex[i].acquire()
+        try:
+            self._tick_local(); self._log('MUTEX_REQ', f"{len(keys)} keys")
+            self._acquire_mutex(name); self._log('MUTEX_GOT', f"{len(keys)} keys")
+            try:
+                deadline=time.monotonic()+0.4
+                for f in self._apply_many(items, wait=True):
+                    try: f.result(max(0.0, deadline-time.monotonic()))
+                    except Exception: pass
+            finally:
+                self._tick_local(); self._release_mutex(name); self._log('MUTEX_REL', f"{len(keys)} keys")
+        finally:
+            for i in reversed(stripes): self.local_mutex[i].release()
+
+    def _apply_many(self, items: List[Tuple[str,str]], wait: bool=False) -> List[Future]:
+        ops=[(k, self.hlc.now(), v) for k,v in items]
+        self._tick_local(); self._log('APPLY_LOCAL', ", ".join(f"{k}={trace_value(v)}" for k,_ts,v in ops[:8])+(" .." if len(ops)>8 else ""))
+        self.kv.put_many(ops)
+        self._tick_local(); self._log('REPL_SEND', f"{len(ops)} keys")
+        return self._replicate(ops, wait)
+
+    # ------- Batches (MGET/MPUT) -------
+    def _split(self, items: List, key) -> Tuple[List, Dict[int, List]]:
+        """Items whose key this node holds, and the others grouped by the key's first owner."""
+        if not self.ring: return items, {}
+        mine=[]; other: Dict[int, List]={}
+        for it in items:
+            owners=self.ring.owners(key(it))
+            if self.id in owners: mine.append(it)
+            else: other.setdefault(owners[0], []).append(it)
+        return mine, other
+
+    def _mget(self, raw: str, keys: List[str], forwarded: bool) -> bytes:
+        if self.raft:
+            if self.raft.role!='leader': return self._to_leader(raw)
+            if not self.raft.barrier(1.0): return b"ERR\n"
+        mine,other=(keys, {}) if forwarded else self._split(keys, lambda k: k)
+        try: futs=[(ks, self._peer(self.gossip.addr_of(nid)).submit("FWD MGET "+" ".join(ks))) for nid,ks in other.items()]
+        except Exception: return b"ERR\n"
+        self._tick_local(); self._log('GET', f"{len(keys)} keys")
+        vals=dict(zip(mine, self.kv.get_many(mine)))
+        for ks,f in futs:
+            try: vals.update(zip(ks, json.loads(f.result(5.0))))
+            except Exception: return b"ERR\n"
+        return (json.dumps([vals[k] for k in keys])+"\n").encode()
+
+    def _mput(self, raw: str, items: List[Tuple[str,str]], forwarded: bool) -> bytes:
+        if self.raft:
+            if self.raft.role!='leader': return self._to_leader(raw)
+            futs=[self.raft.propose(k, v) for k,v in items]
+            try:
+                for f in futs: f.result(5.0)
+            except Exception: return b"ERR\n"
+            return b"OK\n"
+        mine,other=(items, {}) if forwarded else self._split(items, lambda it: it[0])
+        try: futs=[self._peer(self.gossip.addr_of(nid)).submit("FWD MPUT "+json.dumps(dict(its))) for nid,its in other.items()]
+        except Exception: return b"ERR\n"
+        if mine: self._do_put_many(mine)
+        try: ok=all(f.result(10.0)=="OK" for f in futs)
+        except Exception: ok=False
+        return b"OK\n" if ok else b"ERR\n"
 
     # ------- Replication -------
-    def _replicate_put(self, k, v):
-        payload=f"REPL_PUT {k} {v} {self.lamport} {json.dumps(self.vector)}\n".encode()
-        for h,tcp,_udp,i in self.gossip.peers_map:
-            if i==self.id: continue
+    def _replicate(self, ops: List[Tuple[str,int,str]], wait: bool=False) -> List[Future]:
+        """Queue the writes on the replication stream of every peer holding them; never blocks on the network."""
+        if self.ring:
+            per: Dict[int, List[Tuple[str,int,str]]]={}
+            for op in ops:
+                for i in self.ring.owners(op[0]): per.setdefault(i, []).append(op)
+            targets=[(i, self.gossip.addr_of(i), o) for i,o in per.items()]
+        else: targets=[(i, (h,tcp), ops) for h,tcp,_udp,i in self.gossip.peers_map]
+        acks=[]
+        for i,addr,o in targets:
+            if i==self.id or not addr: continue
+            r=self.replicators.get(i)
+            if r is None:
+                with self.conns_lock:
+                    r=self.replicators.get(i) or self.replicators.setdefault(i, Replicator(self, addr))
+            f=r.push(o, self.lamport, list(self.vector), wait)
+            if f: acks.append(f)
+        return acks
+
+    # ------- Quorum reads & writes (R=/W=) -------
+    def _replicas(self, k: str) -> List[int]:
+        """Nodes holding k: its ring owners, or every live node without --rf."""
+        if self.ring: return list(self.ring.owners(k))
+        alive=self.gossip.alive
+        return [i for *_,i in self.gossip.peers_map if i==self.id or i in alive]
+
+    def _quorum_put(self, key: str, val: str, w: int) -> bytes:
+        """
+        Write without the mutex (LWW on the HLC stamp orders concurrent writers)
+        and answer once w replicas, this one included, hold it.
+        """
+        if w>len(self._replicas(key)): return b"ERR\n"
+        pending=set(self._apply_put(key, val, wait=True)); acks=1
+        deadline=time.monotonic()+self.quorum_wait
+        while acks<w and pending:
+            done,pending=futures_wait(pending, max(0.0, deadline-time.monotonic()), FIRST_COMPLETED)
+            if not done: break
+            acks+=sum(1 for f in done if f.exception() is None and f.result()=="OK")
+        return b"OK\n" if acks>=w else f"ERR quorum {acks}/{w}\n".encode()
+
+    def _quorum_get(self, key: str, r: int) -> bytes:
+        """
+        Ask every replica for its version in parallel and answer with the newest
+        of the first r replies; replicas that answered with an older version,
+        now or after the reply went out, are sent the newest one.
+        """
+        reps=self._replicas(key)
+        if r>len(reps): return b"ERR\n"
+        self._tick_local(); self._log('GET', key)
+        seen: Dict[int, Optional[Tuple[int,str]]]={}; asked: Dict[Future,int]={}
+        for i in reps:
+            if i==self.id: seen[i]=self.kv.getv(key); continue
+            try: asked[self._peer(self.gossip.addr_of(i)).submit("GETV "+key)]=i
+            except Exception: pass
+        pending=set(asked); deadline=time.monotonic()+self.quorum_wait
+        while len(seen)<r and pending:
+            done,pending=futures_wait(pending, max(0.0, deadline-time.monotonic()), FIRST_COMPLETED)
+            if not done: break
+            for f in done:
+                v=self._version(f)
+                if v is not False: seen[asked[f]]=v
+        if len(seen)<r: return f"ERR quorum {len(seen)}/{r}\n".encode()
+        best=max((v for v in seen.values() if v), default=None)
+        if best:
+            self._read_repair(key, best, seen)
+            for f in pending:
+                f.add_done_callback(lambda f, i=asked[f]: self._read_repair(key, best, {i: self._version(f)}))
+        return s2b((best[1] if best else '<nil>')+'\n')
+
+    @staticmethod
+    def _version(f: Future):
+        """A GETV reply as (stamp, value) or None; False if the replica did not answer."""
+        if f.exception() is not None: return False
+        ts,_,v=f.result().partition(' ')
+        try: return (int(ts), v) if int(ts) else None
+        except ValueError: return False
+
+    def _read_repair(self, key: str, best: Tuple[int,str], seen: Dict[int, Optional[Tuple[int,str]]]):
+        for i,v in seen.items():
+            if v is False or (v is not None and v>=best): continue
+            self.read_repairs+=1
+            if i==self.id: self.hlc.update(best[0]); self.kv.put(key, best[1], best[0]); continue
+            try: self._peer(self.gossip.addr_of(i)).submit("AE_PUSH "+json.dumps([[key, best[0], best[1]]]))
+            except Exception: pass
+
+    # ------- Partitioning (--rf) -------
+    def _forward(self, owners: List[int], raw: str) -> bytes:
+        """Send a command for a key we do not own to its first reachable owner."""
+        for nid in owners:
+            addr=self.gossip.addr_of(nid)
+            if not addr: continue
+            try: return s2b(self._peer(addr, 0.5).call("FWD "+raw, timeout=5.0)+"\n")
+            except Exception: continue
+        return b"ERR\n"
+
+    def ring_loop(self):
+        """Rebuild the ring when gossip changes the alive set, then hand keys over to their new owners."""
+        while True:
+            self.ring_changed.wait(); time.sleep(self.gossip.period); self.ring_changed.clear()
+            if self.gossip.alive==self.ring.members: continue
+            old,new=self.ring,Ring(self.gossip.alive, self.rf, self.vnodes)
+            self.ring=new
+            self._tick_local(); self._log('RING', ",".join(map(str, new.members)))
+            if self.ae_scoped: self.kv.scope(self._shared(new), new)
+            t0=time.perf_counter(); moved,dropped=self._rebalance(old, new)
+            print(f"[node {self.id}] ring {list(new.members)}: sent {moved} entries, dropped {dropped} in {time.perf_counter()-t0:.2f}s")
+
+    def _rebalance(self, old: Ring, new: Ring, chunk: int=2000) -> Tuple[int,int]:
+        """
+        One store stripe at a time: copy each key to the owners the new ring
+        added (done by the first old owner still alive, so it is sent once),
+        and for keys we no longer own, copy them to all new owners and drop
+        them once that succeeded. Stops early if the ring changes again.
+        """
+        moved=dropped=0
+        for items in self.kv.dump():
+            if self.ring is not new: break
+            out: Dict[int, List]={}; drop=[]
+            for k,(ts,v) in items:
+                owners=new.owners(k); was=old.owners(k)
+                if self.id in owners:
+                    keep=[o for o in was if o in new.members]
+                    if not keep or keep[0]!=self.id: continue
+                    targets=[o for o in owners if o!=self.id and o not in was]
+                else:
+                    targets=owners; drop.append((k,ts))
+                for o in targets: out.setdefault(o, []).append([k,ts,v])
+            ok=True
+            for o,ops in out.items():
+                addr=self.gossip.addr_of(o)
+                try:
+                    for j in range(0, len(ops), chunk):
+                        self._peer(addr, 1.0).call("AE_PUSH "+json.dumps(ops[j:j+chunk]), 10)
+                    moved+=len(ops)
+                except Exception:
+                    ok=False
+            if ok and drop: dropped+=self.kv.drop(drop)
+        return moved,dropped
+
+    # ------- Anti-entropy -------
+    def anti_entropy_loop(self, interval: float):
+        while True:
+            time.sleep(interval)
+            alive=self.gossip.alive_peers()
+            if self.ring: alive=tuple(n for n in alive if n in self.ring.members)
+            peer=random.choice(alive) if alive else None
+            addr=self.gossip.addr_of(peer) if peer is not None else None
+            if not addr: continue
             try:
-                s=socket.create_connection((h,tcp), timeout=0.4)
-                s.sendall(payload); s.close()
+                pulled,pushed=self._ae_round(addr, peer)
             except Exception:
-                pass
+                continue
+            if pulled or pushed:
+                self._tick_local(); self._log('AE_SYNC', f"{addr[0]}:{addr[1]} pulled={pulled} pushed={pushed}")
+
+    def _ae_scope(self, peer: int):
+        """Ring mode: predicate for the keys this node and `peer` both own on the current ring."""
+        ring=self.ring; me=self.id
+        def shared(k: str) -> bool:
+            o=ring.owners(k)
+            return me in o and peer in o
+        return shared
+
+    def _shared(self, ring: Ring):
+        """For KV.scope(): the peers a key is shared with on `ring` (none if we do not own it)."""
+        me=self.id
+        def shared(k: str) -> List[int]:
+            o=ring.owners(k)
+            return [p for p in o if p!=me] if me in o else []
+        return shared
+
+    def _ae_round(self, addr: Tuple[str,int], peer: Optional[int]=None) -> Tuple[int,int]:
+        """
+        Walk both Merkle trees from the root, descending only into children
+        whose hashes differ, then swap the entries of the differing buckets.
+        Traffic grows with the number of divergent buckets, not the store size.
+        In ring mode both trees cover only the key ranges the two nodes share.
+        """
+        conn=self._peer(addr, 1.0); f=KV.FANOUT
+        scoped=self.ring is not None and peer is not None
+        levels=self.kv.scoped_tree(peer, self.ring) if scoped else self.kv.tree(); idx=[0]
+        if levels is None: return 0,0  # scoped digests still being built for a new ring
+        arg=f" {self.id}" if scoped else ""
+        for d in range(KV.DEPTH+1):
+            theirs=conn.call(f"AE_HASH {d} {','.join(map(str, idx))}{arg}", 10).split()
+            if theirs[:1]==['ERR']: return 0,0
+            idx=[i for i,h in zip(idx, theirs) if int(h,16)!=levels[d][i]]
+            if not idx: return 0,0
+            if d<KV.DEPTH: idx=[c for i in idx for c in range(i*f, i*f+f)]
+        keep=self._ae_scope(peer) if scoped else None
+        theirs={k:(ts,v) for k,ts,v in json.loads(conn.call("AE_LEAF "+",".join(map(str, idx))+arg, 10))
+                if keep is None or keep(k)}
+        mine={k:(ts,v) for k,ts,v in self.kv.leaf_items(idx, keep)}
+        pull=[(k,ts,v) for k,(ts,v) in theirs.items() if k not in mine or (ts,v)>mine[k]]
+        push=[[k,ts,v] for k,(ts,v) in mine.items() if k not in theirs or (ts,v)>theirs[k]]
+        if pull:
+            self.hlc.update(max(ts for _k,ts,_v in pull)); self.kv.put_many(pull)
+        if push: conn.call("AE_PUSH "+json.dumps(push), 10)
+        return len(pull),len(push)
+
+    # ------- Raft (--replication raft) -------
+    def _raft_put(self, key: str, val: str) -> bytes:
+        fut=self.raft.propose(key, val)
+        if fut is None: return self._to_leader(f"PUT {key} {val}")
+        self._tick_local(); self._log('RAFT_PROPOSE', f"{key}={trace_value(val)}")
+        try: fut.result(5.0)
+        except Exception: return b"ERR\n"
+        return b"OK\n"
+
+    def _raft_get(self, key: str) -> bytes:
+        """Served by the leader from its store while it holds the read lease; followers forward."""
+        if self.raft.role!='leader': return self._to_leader(f"GET {key}")
+        if not self.raft.barrier(1.0): return b"ERR\n"
+        self._tick_local(); self._log('GET', key)
+        return s2b(self.kv.get(key)+'\n')
+
+    def _to_leader(self, cmd: str) -> bytes:
+        leader=self.raft.leader
+        addr=self.gossip.addr_of(leader) if leader is not None else None
+        if not addr: return b"ERR NOLEADER\n"
+        try: return s2b(self._peer(addr, 0.5).call(cmd, timeout=6.0)+"\n")
+        except Exception: return b"ERR\n"
 
     # ------- Distributed mutex via leader -------
-    def _acquire_mutex(self):
+    def _acquire_mutex(self, key: str):
+        # Each attempt waits on the coordinator for up to lock_wait, then
+        # re-reads the leader in case it changed meanwhile. A reply other than
+        # GRANTED/QUEUED/STALE is an error: back off, and give up after a few.
+        errors=0
         while True:
-            leader=self.gossip.leader()
+            term,leader=self.term,self.leader
             if leader is None:
                 time.sleep(0.05); continue
             if leader==self.id:
-                if self.coord.req(self.id): return
-                time.sleep(0.05); continue
+                grace=self.lead_grace-time.monotonic()
+                if grace>0: time.sleep(grace); continue
+                if self.coord.req(self.id, key, self.lock_wait): return
+                continue
             addr=self.gossip.addr_of(leader)
             if not addr:
                 time.sleep(0.05); continue
             try:
-                s=socket.create_connection(addr, timeout=0.5)
-                s.sendall(f"LOCK_REQ {self.id}\n".encode()); s.shutdown(socket.SHUT_WR)
-                resp=recv_all(s); s.close()
-                if resp.strip()=="GRANTED": return
-            except Exception: pass
-            time.sleep(0.05)
+                resp=self._peer(addr, 0.5).call(f"LOCK_REQ {self.id} {key} {int(self.lock_wait*1000)} {term}", timeout=self.lock_wait+0.5)
+            except Exception:
+                time.sleep(0.05); continue
+            if resp=="GRANTED": return
+            if resp=="QUEUED": errors=0; continue
+            if resp.startswith("STALE"):
+                _,t,l=resp.split()
+                if l!='None': self._adopt(int(t), int(l))
+                time.sleep(0.05); continue
+            errors+=1
+            if errors>=5: raise RuntimeError(f"LOCK_REQ {key}: {resp}")
+            time.sleep(0.05*2**errors)
 
-    def _release_mutex(self):
-        leader=self.gossip.leader()
+    def _release_mutex(self, key: str):
+        leader=self.leader
         if leader==self.id:
-            self.coord.rel(self.id); return
+            self.coord.rel(self.id, key); return
         addr=self.gossip.addr_of(leader)
         if not addr: return
-        try:
-            s=socket.create_connection(addr, timeout=0.5)
-            s.sendall(f"LOCK_REL {self.id}\n".encode()); s.close()
+        try: self._peer(addr, 0.5).submit(f"LOCK_REL {self.id} {key}")
         except Exception: pass
 
+    # ------- Leader election -------
+    def _adopt(self, term: int, leader: int) -> bool:
+        """Follow `leader` if (term, id) is newer than what we follow; True if it changed."""
+        with self.elect_lock:
+            if (term, leader)<=(self.term, self.leader if self.leader is not None else -1): return False
+            self.term, self.leader=term, leader
+            if leader==self.id: self.lead_grace=time.monotonic()+self.coord.lease
+        print(f"[node {self.id}] leader={leader} term={term}")
+        self._tick_local(); self._log('LEADER', f"{leader}@{term}")
+        return True
+
+    def _elect(self):
+        """Bully election among the members gossip sees alive; the highest id that answers wins."""
+        if not self.electing.acquire(blocking=False): return
+        try:
+            acked=False
+            for nid in sorted(n for n in self.gossip.alive_peers() if n>self.id):
+                addr=self.gossip.addr_of(nid)
+                try: resp=self._peer(addr, 0.3).call(f"ELECT {self.term} {self.id}", timeout=0.5) if addr else ''
+                except Exception: continue
+                if resp.startswith('LEADER'):
+                    _,t,l=resp.split()
+                    if int(l) in self.gossip.alive or int(l)==self.id:
+                        self._adopt(int(t), int(l)); return
+                if resp: acked=True
+            if acked:
+                # a higher node runs the election now; give it time to send COORD
+                self.elect_after=time.monotonic()+4*self.gossip.period; return
+            if self._adopt(self.term+1, self.id): self._announce()
+        finally:
+            self.electing.release()
+
+    def _announce(self):
+        """Send COORD for our term to every live member; a STALE answer from a newer leader demotes us."""
+        term=self.term; futs=[]
+        for nid in self.gossip.alive_peers():
+            addr=self.gossip.addr_of(nid)
+            try: futs.append(self._peer(addr, 0.3).submit(f"COORD {term} {self.id}"))
+            except Exception: pass
+        for f in futs:
+            try: resp=f.result(0.5)
+            except Exception: continue
+            if resp.startswith('STALE'):
+                _,t,l=resp.split()
+                if l!='None': self._adopt(int(t), int(l))
+
+    def election_loop(self):
+        """
+        Elect when the leader we follow is gone; a live leader is never
+        preempted. The leader re-announces every other period, which also
+        settles two leaders elected on different sides of a partition or
+        before gossip had seen everyone.
+        """
+        time.sleep(3*self.gossip.period)  # let gossip find the members first
+        n=0
+        while True:
+            n+=1; leader=self.leader
+            if leader==self.id:
+                if n%2==0: self._announce()
+            elif (leader is None or leader not in self.gossip.alive) and time.monotonic()>=self.elect_after:
+                self._elect()
+            time.sleep(self.gossip.period)
+
+    # ------- Durability -------
+    def snapshot_loop(self):
+        while True:
+            time.sleep(1.0)
+            if self.wal.size>=self.snapshot_bytes:
+                t0=time.perf_counter(); self.wal.snapshot(self.kv)
+                print(f"[node {self.id}] snapshot written in {time.perf_counter()-t0:.2f}s")
+
     # ------- Periodic status -------
     def status_loop(self):
         while True:
-            leader=self.gossip.leader()
-            print(f"[node {self.id}] leader={leader} color={self.kv.get('color')} L={self.lamport} V={self.vector}")
+            term,leader=(self.raft.term,self.raft.leader) if self.raft else (self.term,self.leader)
+            print(f"[node {self.id}] leader={leader} term={term} color={self.kv.get('color')} L={self.lamport} V={self.vector} ev_dropped={self.events.dropped}")
             time.sleep(1.0)
 
     # ------- Interactive input on each node -------
@@ -353,9 +2403,7 @@ class Node:
                 val=self.kv.get(parts[1])
                 print(f"GET {parts[1]} -> {val}")
             elif cmd=="PUT" and len(parts)>=3:
-                key=parts[1]; val=" ".join(parts[2:])
-                self._do_put(key,val)
-                print("OK")
+                print(self.dispatch(line).decode().strip())
             else:
                 print("Unknown/invalid. Type 'help'.")
 
@@ -385,6 +2433,8 @@ def main():
     ap.add_argument('--logger', action='store_true', help='Run as logger node')
     ap.add_argument('--logger-tcp', type=int, default=9000)
     ap.add_argument('--numnodes', type=int, default=3)
+    ap.add_argument('--trace-max-events', type=int, default=100000, help='logger: events kept in memory')
+    ap.add_argument('--trace-max-age', type=float, default=0.0, help='logger: drop events older than this many seconds (0 = keep)')
 
     ap.add_argument('--id', type=int)
     ap.add_argument('--tcp', type=int)
@@ -392,11 +2442,33 @@ def main():
     ap.add_argument('--peers', type=str, default='', help='host:tcp=id or host:tcp:udp=id (others; self auto-added)')
     ap.add_argument('--logger-addr', type=str, default='127.0.0.1:9000')
     ap.add_argument('--use-mutex', type=int, default=0, help='0/1 to disable/enable mutex')
+    ap.add_argument('--engine', choices=['thread','asyncio'], default='thread',
+                    help='thread-per-connection server or a single asyncio event loop')
+    ap.add_argument('--shards', type=int, default=16, help='lock stripes in the KV store')
+    ap.add_argument('--data-dir', type=str, default=None, help='enable the write-ahead log and snapshots in this directory')
+    ap.add_argument('--fsync', type=int, default=1, help='0/1: fsync each group commit of the WAL')
+    ap.add_argument('--snapshot-mb', type=float, default=64.0, help='write a snapshot once the WAL grows past this size')
+    ap.add_argument('--lock-lease', type=float, default=2.0, help='seconds a mutex grant lasts unless released or renewed')
+    ap.add_argument('--replication', choices=['broadcast','raft'], default='broadcast',
+                    help='broadcast: every node applies and streams its own PUTs (LWW); raft: PUTs go through a replicated log')
+    ap.add_argument('--raft-election-ms', type=float, default=300, help='raft: minimum election timeout, also the read lease')
+    ap.add_argument('--rf', type=int, default=0,
+                    help='partition keys on a consistent-hash ring with this many replicas each (0 = every node has every key)')
+    ap.add_argument('--vnodes', type=int, default=64, help='ring points per node when --rf is set')
+    ap.add_argument('--gossip-period', type=float, default=0.5, help='SWIM protocol period: one member probed per period')
+    ap.add_argument('--swim-k', type=int, default=3, help='members asked to ping-req a target that missed its ack')
+    ap.add_argument('--suspect-mult', type=float, default=4.0,
+                    help='a suspect is declared dead after mult*max(1,log10(n)) periods without refuting')
+    ap.add_argument('--ae-interval', type=float, default=5.0, help='seconds between anti-entropy rounds (0 = off)')
+    ap.add_argument('--log-buffer', type=int, default=10000, help='trace events buffered for the logger')
+    ap.add_argument('--log-policy', choices=['drop','block'], default='drop',
+                    help='when the trace buffer is full: drop the oldest event or block the writer')
 
     args=ap.parse_args()
 
     if args.logger:
-        Logger(args.logger_tcp, args.numnodes).serve()
+        Logger(args.logger_tcp, args.numnodes, engine=args.engine,
+               max_events=args.trace_max_events, max_age=args.trace_max_age).serve()
         return
 
     if not all([args.id, args.tcp, args.udp]):
@@ -405,7 +2477,10 @@ def main():
     peers=parse_peers(args.peers)
     la_h, la_p = args.logger_addr.split(':'); logger_addr=(la_h,int(la_p))
 
-    Node(args.id, args.tcp, args.udp, peers, logger_addr, args.numnodes, bool(args.use_mutex))
+    Node(args.id, args.tcp, args.udp, peers, logger_addr, args.numnodes, bool(args.use_mutex), args.engine,
+         args.log_buffer, args.log_policy, args.shards, args.data_dir, bool(args.fsync), args.snapshot_mb,
+         args.ae_interval, args.lock_lease, args.gossip_period, args.swim_k, args.suspect_mult,
+         args.replication, args.raft_election_ms, args.rf, args.vnodes)
     # Keep process alive
     while True:
         time.sleep(3600)
@@ -12,32 +12,332 @@
 # Read the key from ALL nodes after the race
 --nodes 127.0.0.1:8001,127.0.0.1:8002,127.0.0.1:8003 -- getall color
 
+# List the keys whose values differ between nodes, with each node's timestamp
+--nodes 127.0.0.1:8001,127.0.0.1:8002,127.0.0.1:8003 -- diff --limit 20
+
 # Quick benchmark (mix of GET/PUT) to random nodes
 --nodes 127.0.0.1:8001,127.0.0.1:8002,127.0.0.1:8003 -- bench --ops 50 --key color --put-ratio 0.3
 
+# Same benchmark with a new connection per command, as older clients did
+--nodes 127.0.0.1:8001,127.0.0.1:8002,127.0.0.1:8003 --oneshot -- bench --ops 50 --key color --put-ratio 0.3
+
+# Open-loop load: 32 workers at 5000 ops/s for 30 s over 100k Zipf-distributed keys, results to JSON
+--nodes 127.0.0.1:8001,127.0.0.1:8002,127.0.0.1:8003 -- bench --concurrency 32 --rate 5000 --duration 30 --warmup 5 --keys 100000 --dist zipf --json run1.json
+
+# Partitioned cluster (--rf): learn the ring and send each key straight to its owner
+--nodes 127.0.0.1:8001,127.0.0.1:8002,127.0.0.1:8003 --ring -- bench --ops 50 --key color --put-ratio 0.3
+
+# Bulk import 1M keys with batched MPUT, read them back with MGET, then list some in key order
+--nodes 127.0.0.1:8001,127.0.0.1:8002,127.0.0.1:8003 -- load --keys 1000000 --batch 1000 --check
+--nodes 127.0.0.1:8001,127.0.0.1:8002,127.0.0.1:8003 -- scan key99 --limit 20
+
+# Fetch retained trace events from the logger, starting at sequence number 0
+--nodes 127.0.0.1:8001,127.0.0.1:8002,127.0.0.1:8003 -- trace --logger 127.0.0.1:9000 --from 0 --count 100
+
 # Interactive REPL 
 --nodes 127.0.0.1:8001,127.0.0.1:8002,127.0.0.1:8003 -- repl
 """
 
-import argparse, socket, time, threading, random, statistics, sys
-from typing import List, Tuple
+import argparse, bisect, heapq, itertools, json, os, socket, time, threading, random, sys
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
 
 # --------------------- TCP helpers ---------------------
 
-def send_cmd(host: str, port: int, cmd: str, timeout: float=2.0) -> str:
-    t0 = time.perf_counter()
-    with socket.create_connection((host, port), timeout=timeout) as s:
-        s.sendall((cmd + "\n").encode())
+# The multiplexed connection, the ring placement, the byte handling and the
+# Merkle tree shape are kv.py's own (it sits next to this file;
+# testing/kvclient.py is a symlink to this one).
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+from kv import KV, Histogram, MuxConn, Ring, b2s, s2b
+
+
+def oneshot_cmd(addr: Tuple[str,int], cmd: str, timeout: float=2.0) -> str:
+    """Legacy protocol: one connection per command, reply read until the node closes it."""
+    return oneshot_send(socket.create_connection(addr, timeout=timeout), cmd)
+
+
+def oneshot_send(conn: socket.socket, cmd: str) -> str:
+    """The exchange of oneshot_cmd on an open connection, which it closes."""
+    with conn as s:
+        s.sendall(s2b(cmd) + b"\n")
         s.shutdown(socket.SHUT_WR)
-        data = s.recv(65535)
-    dt = (time.perf_counter() - t0) * 1000.0
-    return data.decode().strip(), dt
+        chunks = []
+        while True:
+            b = s.recv(65536)
+            if not b:
+                break
+            chunks.append(b)
+    return b2s(b''.join(chunks)).strip()
+
+# --------------------- Client library ------------------
+
+class KVClient:
+    """
+    Client for a KV cluster, usable from other programs:
+
+        c = KVClient([('127.0.0.1', 8001), ('127.0.0.1', 8002)])
+        c.put('color', 'blue'); c.get('color'); c.mget(['a', 'b'])
+
+    Each node gets a pool of up to `pool` multiplexed connections, opened on
+    first use and reopened after a failure; a request goes to the one with the
+    fewest requests in flight. Replies are length-framed, so they are never
+    cut short. A request that could not be sent is retried `retries` times
+    with exponential backoff; one that failed after it was sent (timeout or
+    dropped connection) is retried only if read-only, since a write may have
+    been applied. With oneshot=True every command uses the legacy
+    one-connection protocol.
+    With ring=True the ring of a partitioned cluster (kv.py --rf) is fetched
+    and GET/PUT go straight to the key's first owner.
+    """
+    READ_ONLY = {'GET', 'GETV', 'MGET', 'SCAN', 'SCANV', 'RING', 'LEADER', 'LOCK_STATS', 'AE_HASH', 'AE_LEAF'}
+
+    def __init__(self, nodes: List[Tuple[str,int]], pool: int=2, timeout: float=2.0, retries: int=2,
+                 backoff: float=0.05, oneshot: bool=False, ring: bool=False):
+        self.nodes = list(nodes)
+        self.pool = max(1, pool)
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.oneshot = oneshot
+        self.pools: Dict[Tuple[str,int], List[MuxConn]] = {}
+        self.lock = threading.Lock()
+        self.ring: Optional[Tuple[Ring, Dict[int, Tuple[str,int]]]] = None
+        if ring:
+            self.load_ring()
+
+    # ------- connections -------
+    def _conn(self, addr: Tuple[str,int]) -> MuxConn:
+        with self.lock:
+            conns = self.pools.setdefault(addr, [])
+            conns[:] = [c for c in conns if not c.closed]
+            best = min(conns, key=lambda c: len(c.pending), default=None)
+            if best is not None and (not best.pending or len(conns) >= self.pool):
+                return best
+        c = MuxConn(addr, self.timeout)
+        with self.lock:
+            self.pools[addr].append(c)
+        return c
+
+    def close(self):
+        with self.lock:
+            conns = [c for cs in self.pools.values() for c in cs]
+            self.pools.clear()
+        for c in conns:
+            c.close()
+
+    # ------- routing -------
+    def load_ring(self) -> bool:
+        """Ask the first node that answers for the ring; False if none has one."""
+        for addr in self.nodes:
+            try:
+                r = json.loads(self.call("RING", addr))
+            except Exception:
+                continue
+            addrs = {int(n): (a[0], a[1]) for n, a in r['addrs'].items() if a}
+            self.ring = (Ring(r['members'], r['rf'], r['vnodes']), addrs)
+            return True
+        return False
+
+    def addr_for(self, cmd: str, node=None, route: bool=True) -> Tuple[str,int]:
+        """
+        Where to send cmd: with a ring, a GET/PUT goes to its key's first owner;
+        otherwise to `node` (an index into nodes or a (host, port)), or a random node.
+        """
+        if route and self.ring is not None:
+            parts = cmd.split(None, 2)
+            if len(parts) >= 2 and parts[0].upper() in ('GET', 'PUT'):
+                ring, addrs = self.ring
+                for nid in ring.owners(parts[1]):
+                    if nid in addrs:
+                        return addrs[nid]
+        if node is None:
+            return random.choice(self.nodes)
+        return self.nodes[node] if isinstance(node, int) else tuple(node)
+
+    # ------- requests -------
+    def call(self, cmd: str, node=None, route: bool=True) -> str:
+        return self.timed(cmd, node, route)[0]
+
+    def timed(self, cmd: str, node=None, route: bool=True) -> Tuple[str, float, Tuple[str,int]]:
+        """
+        Send one command; returns (reply, latency in ms including retries, node
+        address). With route=False it goes to `node` even when a ring is loaded.
+        """
+        addr = self.addr_for(cmd, node, route)
+        read_only = cmd.split(None, 1)[0].upper() in self.READ_ONLY
+        t0 = time.perf_counter()
+        for attempt in range(self.retries + 1):
+            sent = False
+            try:
+                if self.oneshot:
+                    conn = socket.create_connection(addr, timeout=self.timeout)
+                    sent = True
+                    out = oneshot_send(conn, cmd)
+                else:
+                    fut = self._conn(addr).submit(cmd)
+                    sent = True
+                    out = fut.result(self.timeout)
+                return out, (time.perf_counter() - t0) * 1000.0, addr
+            except (OSError, FutureTimeout):
+                # once sent, a write may have been applied: resending it could overwrite a newer one
+                if attempt == self.retries or (sent and not read_only):
+                    raise
+                time.sleep(self.backoff * 2 ** attempt)
+
+    def fanout(self, cmd: str, nodes: Optional[List] = None) -> List[Tuple[str, float, Tuple[str,int]]]:
+        """Send cmd to every node (or the given ones) at once; a failure becomes an 'ERR: ...' reply."""
+        targets = self.nodes if nodes is None else nodes
+        res: List = [None] * len(targets)
+        def one(i: int):
+            try:
+                res[i] = self.timed(cmd, targets[i], route=False)
+            except Exception as e:
+                res[i] = (f"ERR: {e}", 0.0, self.addr_for(cmd, targets[i], route=False))
+        ts = [threading.Thread(target=one, args=(i,)) for i in range(len(targets))]
+        for t in ts:
+            t.start()
+        for t in ts:
+            t.join()
+        return res
+
+    def get(self, key: str, node=None) -> str:
+        return self.call(f"GET {key}", node)
+
+    def put(self, key: str, val: str, node=None) -> str:
+        return self.call(f"PUT {key} {val}", node)
+
+    def _pipeline(self, reqs: List[Tuple[str, object]]) -> List[str]:
+        """
+        Send all (command, node) requests before waiting for any reply (node None:
+        route by key). Requests that could not be sent are redone one by one with
+        retries. A read that failed afterwards is redone too; a write is not, since
+        it may have been applied. A request that still failed gets an 'ERR: ...'
+        reply, so one dead node does not lose the replies of the others.
+        """
+        def err(e: Exception) -> str:
+            return f"ERR: {str(e) or type(e).__name__}"
+        def retry(c: str, n) -> str:
+            try:
+                return self.call(c, n)
+            except Exception as e:
+                return err(e)
+        if self.oneshot:
+            return [retry(c, n) for c, n in reqs]
+        futs: List[Optional[Future]] = []
+        for c, n in reqs:
+            try:
+                futs.append(self._conn(self.addr_for(c, n)).submit(c))
+            except OSError:
+                futs.append(None)
+        out = []
+        for (c, n), f in zip(reqs, futs):
+            if f is None:
+                out.append(retry(c, n))
+                continue
+            try:
+                out.append(f.result(self.timeout))
+            except Exception as e:
+                out.append(retry(c, n) if c.split(None, 1)[0].upper() in self.READ_ONLY else err(e))
+        return out
+
+    def _batches(self, keys: List[str], batch: int) -> List[Tuple[Tuple[str,int], List[str]]]:
+        """Keys cut into batches of at most `batch`, each for one node: the keys' first owner with a ring, else spread round-robin."""
+        by: Dict[Optional[Tuple[str,int]], List[str]] = {}
+        for k in keys:
+            by.setdefault(self.addr_for(f"GET {k}") if self.ring is not None else None, []).append(k)
+        out = []
+        for addr, ks in by.items():
+            for j in range(0, len(ks), batch):
+                out.append((addr or self.nodes[len(out) % len(self.nodes)], ks[j:j + batch]))
+        return out
+
+    def mget(self, keys: List[str], batch: int=1000) -> Dict[str, str]:
+        """Values of many keys: one MGET per batch, all batches in flight at once."""
+        groups = self._batches(list(dict.fromkeys(keys)), batch)
+        vals: Dict[str, str] = {}
+        for (addr, ks), r in zip(groups, self._pipeline([("MGET " + " ".join(ks), addr) for addr, ks in groups])):
+            if r == "ERR unknown command":  # node without MGET; any other ERR is the batch's reply
+                vals.update(zip(ks, self._pipeline([(f"GET {k}", None) for k in ks])))
+            elif r.startswith('['):
+                vals.update(zip(ks, json.loads(r)))
+            else:
+                vals.update((k, r) for k in ks)
+        return vals
+
+    def mput(self, items: Dict[str, str], batch: int=1000) -> Dict[str, str]:
+        """Write many keys: one MPUT per batch, all batches in flight at once; returns each key's reply."""
+        groups = self._batches(list(items), batch)
+        reqs = [("MPUT " + json.dumps({k: items[k] for k in ks}), addr) for addr, ks in groups]
+        res: Dict[str, str] = {}
+        for (addr, ks), r in zip(groups, self._pipeline(reqs)):
+            if r == "ERR unknown command":  # node without MPUT; any other ERR is the batch's reply
+                res.update(zip(ks, self._pipeline([(f"PUT {k} {items[k]}", None) for k in ks])))
+            else:
+                res.update((k, r) for k in ks)
+        return res
+
+    def _scan_node(self, addr: Tuple[str,int], prefix: str, page: int, cmd: str='SCAN') -> Iterator[Tuple]:
+        cursor = None
+        while True:
+            r = json.loads(self.call(f"{cmd} {prefix or '*'} {page}" + (f" {cursor}" if cursor else ""), addr, route=False))
+            for item in r['items']:
+                yield tuple(item)
+            cursor = r['cursor']
+            if cursor is None:
+                return
+
+    def scan(self, prefix: str='', page: int=1000, node=None) -> Iterator[Tuple[str, str]]:
+        """
+        (key, value) of every key with the prefix, in key order, fetched `page`
+        keys at a time with SCAN cursors. With a ring each node holds only some
+        keys, so all nodes are scanned with SCANV and their streams merged; of
+        a key's replicas the one with the greatest (stamp, value) wins, as in
+        the store itself.
+        """
+        if self.ring is None:
+            yield from self._scan_node(self.addr_for('', node if node is not None else 0), prefix, page)
+            return
+        # (key, stamp, value) tuples sort a key's replicas oldest first, so the last one is kept
+        last = None
+        for item in heapq.merge(*(self._scan_node(a, prefix, page, 'SCANV') for a in self.ring[1].values())):
+            if last is not None and item[0] != last[0]:
+                yield last[0], last[2]
+            last = item
+        if last is not None:
+            yield last[0], last[2]
+
+
+CLIENT: Optional[KVClient] = None      # set up in main from the command line
+
+# --------------------- Load generation -----------------
+
+# Bench latencies: kv.Histogram with 2**5 buckets per power of two (~3% error),
+# and the quantiles reported per operation and per node.
+HIST_SUB = 5
+HIST_QS = (0.5, 0.9, 0.99, 0.999)
+
+
+def key_chooser(key: str, keys: int, dist: str, zipf_s: float=0.99,
+                hot_frac: float=0.01, hot_prob: float=0.9) -> Callable[[random.Random], str]:
+    """
+    Picks keys <key>0..<key>{keys-1}: uniform, Zipf (rank i drawn with weight
+    1/(i+1)**s, key 0 hottest) or hotspot (hot_prob of the requests go to the
+    first hot_frac of the keys). A single key is used as given.
+    """
+    if keys <= 1:
+        return lambda rnd: key
+    if dist == 'zipf':
+        cdf = list(itertools.accumulate(1.0 / (i + 1) ** zipf_s for i in range(keys)))
+        return lambda rnd: f"{key}{min(keys - 1, bisect.bisect(cdf, rnd.random() * cdf[-1]))}"
+    if dist == 'hotspot':
+        hot = min(keys, max(1, int(keys * hot_frac)))
+        return lambda rnd: f"{key}{rnd.randrange(hot) if hot == keys or rnd.random() < hot_prob else rnd.randrange(hot, keys)}"
+    return lambda rnd: f"{key}{rnd.randrange(keys)}"
 
 # --------------------- Actions -------------------------
 
 def action_cmd(nodes: List[Tuple[str,int]], node_idx: int, cmd: str):
-    host, port = nodes[node_idx]
-    out, dt = send_cmd(host, port, cmd)
+    out, dt, (host, port) = CLIENT.timed(cmd, node_idx)
     print(f"[{host}:{port}] {cmd} -> {out} ({dt:.2f} ms)")
 
 
@@ -51,7 +351,7 @@ def action_race(nodes: List[Tuple[str,int]], cmd1: str, cmd2: str):
     res = {}
     def tfunc(key, host, port, cmd):
         try:
-            out, dt = send_cmd(host, port, cmd)
+            out, dt, _ = CLIENT.timed(cmd, (host, port))
             res[key] = (out, dt)
         except Exception as e:
             res[key] = (f"ERR: {e}", 0)
@@ -63,32 +363,215 @@ def action_race(nodes: List[Tuple[str,int]], cmd1: str, cmd2: str):
 
 
 def action_getall(nodes: List[Tuple[str,int]], key: str):
-    for (h,p) in nodes:
-        out, dt = send_cmd(h, p, f"GET {key}")
+    for out, dt, (h, p) in CLIENT.fanout(f"GET {key}", nodes):
         print(f"[{h}:{p}] GET {key} -> {out} ({dt:.2f} ms)")
 
 
-def action_bench(nodes: List[Tuple[str,int]], ops: int, key: str, put_ratio: float):
-    lat = []
-    puts = gets = 0
-    for i in range(ops):
-        h,p = random.choice(nodes)
-        do_put = random.random() < put_ratio
-        if do_put:
-            val = f"v{i}"
-            out, dt = send_cmd(h, p, f"PUT {key} {val}")
-            puts += 1
-        else:
-            out, dt = send_cmd(h, p, f"GET {key}")
-            gets += 1
-        lat.append(dt)
-    if lat:
-        print(f"ops={ops} puts={puts} gets={gets} avg={statistics.mean(lat):.2f} ms p95={statistics.quantiles(lat, n=20)[18]:.2f} ms max={max(lat):.2f} ms")
+# kv.py's Merkle tree: FANOUT children per node over FANOUT**DEPTH buckets.
+AE_FANOUT = KV.FANOUT
+AE_DEPTH = KV.DEPTH
+
+def hlc_str(ts: int) -> str:
+    """A kv.py HLC stamp as wall-clock time plus its logical counter."""
+    ms = ts >> 16
+    return time.strftime('%H:%M:%S', time.localtime(ms / 1000)) + f".{ms % 1000:03d}+{ts & 0xffff}"
+
+
+def action_diff(nodes: List[Tuple[str,int]], chunk: int=256, limit: int=50):
+    """
+    Report keys whose copies differ between nodes without copying any store:
+    walk the anti-entropy Merkle trees of all nodes top-down in parallel,
+    descending only where the hashes disagree, then fetch just the differing
+    buckets from every node, `chunk` buckets at a time. With --ring a key is
+    compared across its owners only.
+    """
+    t0 = time.perf_counter()
+    idx = [0]
+    for lvl in range(AE_DEPTH + 1):
+        differ = []
+        for j in range(0, len(idx), 4096):
+            part = idx[j:j + 4096]
+            res = CLIENT.fanout(f"AE_HASH {lvl} {','.join(map(str, part))}", nodes)
+            for out, _, (h, p) in res:
+                if out.startswith('ERR'):
+                    print(f"[{h}:{p}] cannot read its Merkle tree: {out}")
+                    return
+            hashes = [out.split() for out, _, _ in res]
+            differ += [i for n, i in enumerate(part) if len({hs[n] for hs in hashes}) > 1]
+        print(f"level {lvl}: {len(differ)} of {len(idx)} subtrees differ")
+        if not differ:
+            print(f"all {len(nodes)} nodes agree ({time.perf_counter() - t0:.2f}s)")
+            return
+        if lvl < AE_DEPTH:
+            idx = [c for i in differ for c in range(i * AE_FANOUT, (i + 1) * AE_FANOUT)]
+    names = [f"{h}:{p}" for h, p in nodes]
+    ids = {}
+    if CLIENT.ring is not None:
+        ids = {addr: nid for nid, addr in CLIENT.ring[1].items()}
+    found = fetched = 0
+    for j in range(0, len(differ), chunk):
+        res = CLIENT.fanout(f"AE_LEAF {','.join(map(str, differ[j:j + chunk]))}", nodes)
+        versions: Dict[str, List[Optional[Tuple[int,str]]]] = {}
+        for n, (out, _, _) in enumerate(res):
+            items = json.loads(out) if out.startswith('[') else []
+            fetched += len(items)
+            for k, ts, v in items:
+                versions.setdefault(k, [None] * len(nodes))[n] = (ts, v)
+        for k in sorted(versions):
+            vs = versions[k]
+            cols = range(len(nodes))
+            if ids:
+                owners = CLIENT.ring[0].owners(k)
+                cols = [n for n in cols if ids.get(tuple(nodes[n])) in owners]
+            if len({vs[n][1] if vs[n] else None for n in cols}) <= 1:
+                continue
+            found += 1
+            if found <= limit:
+                print(k)
+                for n in cols:
+                    print(f"  {names[n]:22} " + (f"{hlc_str(vs[n][0])}  {vs[n][1]}" if vs[n] else "<missing>"))
+    more = f", first {limit} shown" if found > limit else ""
+    print(f"{found} divergent keys{more}; {len(differ)} buckets, {fetched} entries fetched in {time.perf_counter() - t0:.2f}s")
+
+
+def action_bench(nodes: List[Tuple[str,int]], ops: int, key: str, put_ratio: float,
+                 keys: int=1, dist: str='uniform', concurrency: int=1, rate: float=0.0,
+                 duration: float=0.0, warmup: float=0.0, zipf_s: float=0.99, hot_frac: float=0.01,
+                 hot_prob: float=0.9, json_out: Optional[str]=None, seed: Optional[int]=None):
+    """
+    Run `ops` operations, or as many as fit in `duration` seconds, from
+    `concurrency` worker threads. With a target `rate` the load is open-loop:
+    request i is due at start + i/rate whether or not earlier ones finished,
+    and its latency is counted from that due time, so a stalled cluster shows
+    up as latency instead of silently lowering the offered load. Requests
+    due in the first `warmup` seconds are not recorded.
+    """
+    pick = key_chooser(key, keys, dist, zipf_s, hot_frac, hot_prob)
+    seq = itertools.count()
+    start = time.perf_counter() + 0.05
+    end = start + warmup + duration if duration else None
+    measure_from = start + warmup
+    results: List[Dict] = []
+
+    def worker(wid: int):
+        rnd = random.Random(None if seed is None else seed + wid)
+        st = {'get': Histogram(HIST_SUB), 'put': Histogram(HIST_SUB), 'nodes': {}, 'errors': 0, 'last': measure_from}
+        while True:
+            i = next(seq)
+            if end is None and i >= ops:
+                break
+            due = start + i / rate if rate else max(start, time.perf_counter())
+            if end is not None and due >= end:
+                break
+            wait = due - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+            op = 'put' if rnd.random() < put_ratio else 'get'
+            k = pick(rnd)
+            cmd = f"PUT {k} v{i}" if op == 'put' else f"GET {k}"
+            h, p = CLIENT.addr_for(cmd, rnd.choice(nodes))
+            try:
+                ok = not CLIENT.call(cmd, (h, p)).startswith('ERR')
+            except Exception:
+                ok = False
+            done = time.perf_counter()
+            if due < measure_from:
+                continue
+            st['last'] = max(st['last'], done)
+            if not ok:
+                st['errors'] += 1
+                continue
+            st[op].add(done - due)
+            st['nodes'].setdefault(f"{h}:{p}", Histogram(HIST_SUB)).add(done - due)
+        results.append(st)
+
+    ts = [threading.Thread(target=worker, args=(w,)) for w in range(max(1, concurrency))]
+    for t in ts:
+        t.start()
+    for t in ts:
+        t.join()
+
+    by_op = {'get': Histogram(HIST_SUB), 'put': Histogram(HIST_SUB)}
+    by_node: Dict[str, Histogram] = {}
+    for st in results:
+        for op in by_op:
+            by_op[op].merge(st[op])
+        for n, hist in st['nodes'].items():
+            by_node.setdefault(n, Histogram(HIST_SUB)).merge(hist)
+    total = Histogram(HIST_SUB)
+    for hist in by_op.values():
+        total.merge(hist)
+    errors = sum(st['errors'] for st in results)
+    elapsed = max(1e-9, max(st['last'] for st in results) - measure_from)
+    if not total.count:
+        print(f"no operations recorded (errors={errors})")
+        return
+    print(f"ops={total.count} puts={by_op['put'].count} gets={by_op['get'].count} "
+          f"avg={total.total / total.count / 1000:.2f} ms p95={total.quantile(0.95) / 1000:.2f} ms "
+          f"max={total.max / 1000:.2f} ms")
+    print(f"{'':22} {'count':>8} {'ops/s':>9} {'p50':>8} {'p90':>8} {'p99':>8} {'p99.9':>8} {'max':>8}")
+    rows = [(op, by_op[op]) for op in ('get', 'put') if by_op[op].count] + sorted(by_node.items())
+    for name, hist in rows:
+        ms = [hist.quantile(q) / 1000 for q in HIST_QS] + [hist.max / 1000]
+        print(f"{name:22} {hist.count:>8} {hist.count / elapsed:>9.0f} " + " ".join(f"{v:>8.2f}" for v in ms))
+    print(f"elapsed={elapsed:.2f}s achieved={total.count / elapsed:.0f} ops/s target={rate or 'closed-loop'} errors={errors}")
+    if json_out:
+        res = {'config': {'nodes': [f"{h}:{p}" for h, p in nodes], 'ops': ops, 'duration': duration,
+                          'warmup': warmup, 'concurrency': concurrency, 'rate': rate, 'put_ratio': put_ratio,
+                          'key': key, 'keys': keys, 'dist': dist, 'zipf_s': zipf_s, 'hot_frac': hot_frac,
+                          'hot_prob': hot_prob, 'oneshot': CLIENT.oneshot, 'pool': CLIENT.pool,
+                          'ring': CLIENT.ring is not None},
+               'elapsed_s': elapsed, 'ops_per_s': total.count / elapsed, 'errors': errors,
+               'total': total.summary(HIST_QS), 'ops': {op: h.summary(HIST_QS) for op, h in by_op.items() if h.count},
+               'nodes': {n: h.summary(HIST_QS) for n, h in sorted(by_node.items())}}
+        with open(json_out, 'w') as f:
+            json.dump(res, f, indent=1)
+        print(f"results written to {json_out}")
+
+def action_scan(prefix: str, page: int, limit: int):
+    t0 = time.perf_counter()
+    n = 0
+    for k, v in CLIENT.scan(prefix, page):
+        n += 1
+        if n <= limit:
+            print(f"{k} -> {v}")
+    more = f", first {limit} shown" if n > limit else ""
+    print(f"{n} keys with prefix '{prefix}'{more} ({time.perf_counter() - t0:.2f}s)")
+
+
+def action_load(keys: int, prefix: str, batch: int, value_size: int, check: bool):
+    """Bulk import <prefix>0..<prefix>{keys-1} with MPUT, several batches in flight."""
+    pad = 'x' * max(0, value_size - 8)
+    t0 = time.perf_counter()
+    step = batch * 8
+    errors = 0
+    for j in range(0, keys, step):
+        res = CLIENT.mput({f"{prefix}{i}": f"{i:08d}{pad}" for i in range(j, min(keys, j + step))}, batch)
+        errors += sum(1 for r in res.values() if r != "OK")
+    dt = time.perf_counter() - t0
+    print(f"loaded {keys} keys in {dt:.2f}s ({keys / dt:.0f} keys/s), errors={errors}")
+    if check:
+        t0 = time.perf_counter()
+        bad = 0
+        for j in range(0, keys, step):
+            vals = CLIENT.mget([f"{prefix}{i}" for i in range(j, min(keys, j + step))], batch)
+            bad += sum(1 for k, v in vals.items() if v != f"{int(k[len(prefix):]):08d}{pad}")
+        print(f"read back in {time.perf_counter() - t0:.2f}s, mismatches={bad}")
+
+
+def action_trace(logger: Tuple[str,int], start: int, count: int):
+    with socket.create_connection(logger, timeout=5.0) as s:
+        s.sendall(f"TRACE {start} {count}\n".encode())
+        with s.makefile('rb') as f:
+            res = json.loads(f.readline())
+    for e in res['events']:
+        print(f"#{e['seq']} t={e['phy_ts']:.6f} L={e['lamport']:>3} V={e['vector']} layer={e['layer']} node={e['node']} {e['stage']} {e['op']}")
+    print(f"retained from #{res['first']}; next window starts at #{res['next']}")
 
 # --------------------- REPL ----------------------------
 
 def action_repl(nodes: List[Tuple[str,int]]):
-    print("KV REPL. cmds: help | nodes | use <idx> | cmd <raw> | getall <key> | race <cmd1> | <cmd2> | quit")
+    print("KV REPL. cmds: help | nodes | use <idx> | cmd <raw> | getall <key> | mget <k1> <k2>.. | race <cmd1> | <cmd2> | quit")
     cur = 0
     while True:
         try:
@@ -100,7 +583,7 @@ def action_repl(nodes: List[Tuple[str,int]]):
         if line == 'quit':
             break
         if line == 'help':
-            print("nodes -> list nodes; use <i> -> choose node; cmd <raw> -> send; getall <k>; race <cmd1> | <cmd2>")
+            print("nodes -> list nodes; use <i> -> choose node; cmd <raw> -> send; getall <k>; mget <k1> <k2>..; race <cmd1> | <cmd2>")
             continue
         if line == 'nodes':
             for i,(h,p) in enumerate(nodes):
@@ -117,10 +600,16 @@ def action_repl(nodes: List[Tuple[str,int]]):
             continue
         if line.startswith('cmd '):
             cmd = line[4:]
-            h,p = nodes[cur]
-            out, dt = send_cmd(h, p, cmd)
+            out, dt, (h, p) = CLIENT.timed(cmd, cur)
             print(f"[{h}:{p}] {cmd} -> {out} ({dt:.2f} ms)")
             continue
+        if line.startswith('mget '):
+            t0 = time.perf_counter()
+            vals = CLIENT.mget(line.split()[1:])
+            for k, v in vals.items():
+                print(f"  {k} -> {v}")
+            print(f"({(time.perf_counter() - t0) * 1000:.2f} ms)")
+            continue
         if line.startswith('getall '):
             key = line.split(' ',1)[1]
             action_getall(nodes, key)
@@ -146,6 +635,12 @@ def parse_nodes(s: str) -> List[Tuple[str,int]]:
 if __name__ == '__main__':
     ap = argparse.ArgumentParser(description='kv client')
     ap.add_argument('--nodes', required=True, help='comma list of host:port')
+    ap.add_argument('--mux', action='store_true', help=argparse.SUPPRESS)  # now the default
+    ap.add_argument('--oneshot', action='store_true', help='legacy protocol: a new connection for every command')
+    ap.add_argument('--pool', type=int, default=2, help='multiplexed connections per node')
+    ap.add_argument('--timeout', type=float, default=2.0, help='seconds to wait for a reply')
+    ap.add_argument('--retries', type=int, default=2, help='retries after a broken connection (or a timed-out read)')
+    ap.add_argument('--ring', action='store_true', help='fetch the ring (kv.py --rf) and send GET/PUT to the key owner')
 
     sub = ap.add_subparsers(dest='mode', required=True)
 
@@ -160,15 +655,48 @@ if __name__ == '__main__':
     sp = sub.add_parser('getall', help='GET a key from all nodes')
     sp.add_argument('key')
 
-    sp = sub.add_parser('bench', help='simple latency benchmark')
-    sp.add_argument('--ops', type=int, default=50)
-    sp.add_argument('--key', default='color')
+    sp = sub.add_parser('diff', help='find keys that differ between nodes, via their Merkle trees')
+    sp.add_argument('--chunk', type=int, default=256, help='buckets fetched per request')
+    sp.add_argument('--limit', type=int, default=50, help='divergent keys to print')
+
+    sp = sub.add_parser('bench', help='latency benchmark / load generator')
+    sp.add_argument('--ops', type=int, default=50, help='operations to run (ignored with --duration)')
+    sp.add_argument('--key', default='color', help='the key, or the key prefix with --keys')
     sp.add_argument('--put-ratio', type=float, default=0.5)
+    sp.add_argument('--keys', type=int, default=1, help='spread requests over this many keys')
+    sp.add_argument('--dist', choices=['uniform', 'zipf', 'hotspot'], default='uniform', help='key distribution')
+    sp.add_argument('--zipf-s', type=float, default=0.99, help='Zipf exponent')
+    sp.add_argument('--hot-frac', type=float, default=0.01, help='hotspot: fraction of keys that are hot')
+    sp.add_argument('--hot-prob', type=float, default=0.9, help='hotspot: fraction of requests to hot keys')
+    sp.add_argument('--concurrency', type=int, default=1, help='worker threads')
+    sp.add_argument('--rate', type=float, default=0.0, help='target ops/s, open-loop (0 = closed-loop, as fast as possible)')
+    sp.add_argument('--duration', type=float, default=0.0, help='run for this many seconds instead of --ops')
+    sp.add_argument('--warmup', type=float, default=0.0, help='seconds at the start that are not recorded')
+    sp.add_argument('--seed', type=int, default=None)
+    sp.add_argument('--json', dest='json_out', default=None, help='write the results to this JSON file')
+
+    sp = sub.add_parser('scan', help='list keys with a prefix, in order (SCAN cursors)')
+    sp.add_argument('prefix', nargs='?', default='')
+    sp.add_argument('--page', type=int, default=1000, help='keys per SCAN request')
+    sp.add_argument('--limit', type=int, default=50, help='keys to print')
+
+    sp = sub.add_parser('load', help='bulk import keys with batched MPUT')
+    sp.add_argument('--keys', type=int, default=100000)
+    sp.add_argument('--prefix', default='key')
+    sp.add_argument('--batch', type=int, default=1000, help='keys per MPUT')
+    sp.add_argument('--value-size', type=int, default=16)
+    sp.add_argument('--check', action='store_true', help='read everything back with MGET and compare')
+
+    sp = sub.add_parser('trace', help='fetch a window of retained events from the logger')
+    sp.add_argument('--logger', default='127.0.0.1:9000', help='logger host:port')
+    sp.add_argument('--from', dest='start', type=int, default=0, help='first sequence number')
+    sp.add_argument('--count', type=int, default=100)
 
     sp = sub.add_parser('repl', help='interactive shell')
 
     args = ap.parse_args()
     nodes = parse_nodes(args.nodes)
+    CLIENT = KVClient(nodes, args.pool, args.timeout, args.retries, oneshot=args.oneshot, ring=args.ring)
 
     if args.mode == 'cmd':
         raw = ' '.join(args.raw).strip()
@@ -180,8 +708,19 @@ if __name__ == '__main__':
         action_race(nodes, args.cmd1, args.cmd2)
     elif args.mode == 'getall':
         action_getall(nodes, args.key)
+    elif args.mode == 'diff':
+        action_diff(nodes, args.chunk, args.limit)
     elif args.mode == 'bench':
-        action_bench(nodes, args.ops, args.key, args.put_ratio)
+        action_bench(nodes, args.ops, args.key, args.put_ratio, args.keys, args.dist, args.concurrency,
+                     args.rate, args.duration, args.warmup, args.zipf_s, args.hot_frac, args.hot_prob,
+                     args.json_out, args.seed)
+    elif args.mode == 'scan':
+        action_scan(args.prefix, args.page, args.limit)
+    elif args.mode == 'load':
+        action_load(args.keys, args.prefix, args.batch, args.value_size, args.check)
+    elif args.mode == 'trace':
+        lh, lp = args.logger.split(':')
+        action_trace((lh, int(lp)), args.start, args.count)
     elif args.mode == 'repl':
         action_repl(nodes)
 
@@ -0,0 +1,726 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the Task2 KV node. Run from Task2/testing.
+
+# Thread-per-connection vs asyncio server engine, 1000 concurrent multiplexed connections
+python3 ./kvbench.py engines --conns 1000 --duration 10
+
+# Same, but every request is a legacy one-shot connection
+python3 ./kvbench.py engines --conns 1000 --duration 10 --mode oneshot
+
+# KV store lock striping, 8 threads, GET-heavy and PUT-heavy mixes
+python3 ./kvbench.py shards --threads 8 --shards 1,4,16,64
+
+# PUT throughput with the WAL (group commit, fsync on/off) and recovery time
+python3 ./kvbench.py wal --threads 1,8,32 --keys 1000000
+
+# Anti-entropy cost on a large store: Merkle tree build and divergent buckets found
+python3 ./kvbench.py ae --keys 1000000 --diverge 10,1000
+
+# Leader mutex handoff under contention, 3..16 writers (--poll: old 50 ms polling)
+python3 ./kvbench.py mutex --writers 3,8,16 --duration 5
+
+# Per-key locks: throughput as 8 writers spread over more keys, each holding 1 ms
+python3 ./kvbench.py mutex --writers 8 --keys 1,2,4,8 --hold-ms 1
+
+# SWIM failure detector with 200 in-process members, 10% datagram loss, 2 members killed
+python3 ./kvbench.py gossip --nodes 50,200 --loss 0.1 --kill 2
+
+# Write availability under the leader mutex while the elected leader is killed 3 times
+python3 ./kvbench.py failover --kills 3
+
+# Linearizable writes: leader mutex per PUT vs the raft log, plus lease reads
+python3 ./kvbench.py replication --clients 64 --duration 10
+
+# Per-request consistency: no mutex (W=1) vs quorum PUT W=2 / GET R=2 vs the mutex
+python3 ./kvbench.py replication --modes eventual,quorum,mutex --quorum 2
+
+# Logger vector-clock layering: incremental index vs the old full recomputation
+python3 ./kvbench.py layers --events 10000,100000
+
+# Byte-exact values: whitespace, control bytes and invalid UTF-8 read back from every node
+python3 ./kvbench.py binary --engines thread,asyncio
+"""
+
+import argparse, asyncio, os, random, resource, shutil, socket, subprocess, sys, tempfile, threading, time
+from typing import Dict, List
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+KV_PY = os.path.join(HERE, '..', 'program', 'kv.py')
+sys.path.insert(0, os.path.dirname(KV_PY))
+import kv
+
+# --------------------- helpers -------------------------
+
+def raise_nofile():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def start_node(nid: int, tcp: int, extra: List[str], peers: str='', numnodes: int=1) -> subprocess.Popen:
+    """Start a kv.py node in the background and wait until its TCP port accepts."""
+    cmd = [sys.executable, KV_PY, '--id', str(nid), '--tcp', str(tcp), '--udp', str(tcp + 100),
+           '--numnodes', str(numnodes), '--logger-addr', '127.0.0.1:1'] + extra
+    if peers:
+        cmd += ['--peers', peers]
+    p = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', tcp), timeout=0.2).close()
+            return p
+        except OSError:
+            time.sleep(0.05)
+    p.kill()
+    raise RuntimeError(f"node on {tcp} did not start")
+
+
+def threads_of(pid: int) -> int:
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('Threads:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def pct(lat: List[float], q: float) -> float:
+    if not lat:
+        return 0.0
+    lat = sorted(lat)
+    return lat[min(len(lat) - 1, int(q * len(lat)))]
+
+# --------------------- engines -------------------------
+
+async def _mux_worker(port: int, stop: float, put_ratio: float, lat: List[float], wid: int):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(kv.MUX_MAGIC)
+    rid = 0
+    while time.perf_counter() < stop:
+        rid += 1
+        cmd = (f"PUT k{wid % 100} v{rid}" if random.random() < put_ratio else f"GET k{wid % 100}").encode()
+        t0 = time.perf_counter()
+        writer.write(kv.FRAME.pack(len(cmd), rid) + cmd)
+        n, _ = kv.FRAME.unpack(await reader.readexactly(kv.FRAME.size))
+        await reader.readexactly(n)
+        lat.append((time.perf_counter() - t0) * 1000.0)
+    writer.close()
+
+
+async def _oneshot_worker(port: int, stop: float, put_ratio: float, lat: List[float], wid: int):
+    i = 0
+    while time.perf_counter() < stop:
+        i += 1
+        cmd = (f"PUT k{wid % 100} v{i}\n" if random.random() < put_ratio else f"GET k{wid % 100}\n").encode()
+        t0 = time.perf_counter()
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(cmd)
+            writer.write_eof()
+            await reader.read()
+            writer.close()
+        except OSError:
+            await asyncio.sleep(0.01)
+            continue
+        lat.append((time.perf_counter() - t0) * 1000.0)
+
+
+async def _drive(port: int, pid: int, conns: int, duration: float, put_ratio: float, mode: str) -> Dict:
+    lat: List[float] = []
+    worker = _mux_worker if mode == 'mux' else _oneshot_worker
+    stop = time.perf_counter() + duration
+    tasks = [asyncio.ensure_future(worker(port, stop, put_ratio, lat, i)) for i in range(conns)]
+    peak = 0
+    while not all(t.done() for t in tasks):
+        peak = max(peak, threads_of(pid))
+        await asyncio.sleep(0.25)
+    errors = sum(1 for t in tasks if t.exception() is not None)
+    return {'ops': len(lat), 'lat': lat, 'peak_threads': peak, 'errors': errors}
+
+
+def bench_engines(args):
+    raise_nofile()
+    print(f"{'engine':8} {'mode':8} {'conns':>6} {'ops/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'threads':>8} {'errors':>7}")
+    for engine in args.engines.split(','):
+        p = start_node(1, args.port, ['--engine', engine])
+        try:
+            r = asyncio.run(_drive(args.port, p.pid, args.conns, args.duration, args.put_ratio, args.mode))
+        finally:
+            p.kill()
+            p.wait()
+        print(f"{engine:8} {args.mode:8} {args.conns:>6} {r['ops'] / args.duration:>9.0f} "
+              f"{pct(r['lat'], 0.5):>8.2f} {pct(r['lat'], 0.99):>8.2f} {r['peak_threads']:>8} {r['errors']:>7}")
+        time.sleep(0.5)
+
+# --------------------- shards --------------------------
+
+def _kv_worker(store: 'kv.KV', keys: List[str], ops: int, put_ratio: float, seed: int, go: threading.Event):
+    rnd = random.Random(seed)
+    hlc = kv.HLC()
+    picks = [(rnd.random() < put_ratio, rnd.choice(keys)) for _ in range(ops)]
+    go.wait()
+    for is_put, k in picks:
+        if is_put:
+            store.put(k, 'v', hlc.now())
+        else:
+            store.get(k)
+
+
+def bench_shards(args):
+    keys = [f"key{i}" for i in range(args.keys)]
+    print(f"{'shards':>6} {'mix':>10} {'threads':>7} {'ops/s':>10}")
+    for put_ratio, mix in ((0.1, 'get-heavy'), (0.9, 'put-heavy')):
+        for shards in [int(x) for x in args.shards.split(',')]:
+            store = kv.KV(shards)
+            store.put_many([(k, 0, 'v') for k in keys])
+            go = threading.Event()
+            ts = [threading.Thread(target=_kv_worker, args=(store, keys, args.ops, put_ratio, i, go))
+                  for i in range(args.threads)]
+            for t in ts:
+                t.start()
+            t0 = time.perf_counter()
+            go.set()
+            for t in ts:
+                t.join()
+            dt = time.perf_counter() - t0
+            print(f"{shards:>6} {mix:>10} {args.threads:>7} {args.threads * args.ops / dt:>10.0f}")
+
+# --------------------- wal -----------------------------
+
+def _put_worker(store: 'kv.KV', wid: int, ops: int, go: threading.Event):
+    hlc = kv.HLC()
+    go.wait()
+    for i in range(ops):
+        store.put(f"w{wid}k{i}", f"value-{i}", hlc.now())
+
+
+def bench_wal(args):
+    base = tempfile.mkdtemp(prefix='kvbench-wal-', dir=args.dir)
+    try:
+        print(f"{'durability':>12} {'threads':>7} {'puts/s':>9} {'puts/fsync':>10}")
+        for mode in ('memory', 'wal-nofsync', 'wal-fsync'):
+            for threads in [int(x) for x in args.threads.split(',')]:
+                d = os.path.join(base, f"{mode}-{threads}")
+                wal = None if mode == 'memory' else kv.WAL(d, fsync=(mode == 'wal-fsync'))
+                store = kv.KV(16, wal)
+                if wal:
+                    wal.recover(store)
+                go = threading.Event()
+                ts = [threading.Thread(target=_put_worker, args=(store, i, args.ops, go)) for i in range(threads)]
+                for t in ts:
+                    t.start()
+                t0 = time.perf_counter()
+                go.set()
+                for t in ts:
+                    t.join()
+                dt = time.perf_counter() - t0
+                per = f"{threads * args.ops / wal.commits:.1f}" if wal else '-'
+                print(f"{mode:>12} {threads:>7} {threads * args.ops / dt:>9.0f} {per:>10}")
+
+        d = os.path.join(base, 'recovery')
+        wal = kv.WAL(d, fsync=False)
+        store = kv.KV(16, wal)
+        wal.recover(store)
+        store.put_many([(f"key{i}", 1, f"value-{i}") for i in range(args.keys)])
+        t0 = time.perf_counter()
+        wal.snapshot(store)
+        snap = time.perf_counter() - t0
+        store.put_many([(f"key{i}", 2, f"new-{i}") for i in range(args.keys // 10)])
+        t0 = time.perf_counter()
+        n = kv.WAL(d).recover(kv.KV(16))
+        print(f"snapshot of {args.keys} keys: {snap:.2f} s; startup (snapshot + {args.keys // 10} WAL records, {n} total): {time.perf_counter() - t0:.2f} s")
+    finally:
+        shutil.rmtree(base, ignore_errors=True)
+
+# --------------------- ae ------------------------------
+
+def bench_ae(args):
+    a, b = kv.KV(16), kv.KV(16)
+    items = [(f"key{i}", 1, f"value-{i}") for i in range(args.keys)]
+    a.put_many(items)
+    b.put_many(items)
+    t0 = time.perf_counter()
+    a.tree()
+    print(f"tree build over {args.keys} keys: {(time.perf_counter() - t0) * 1000:.1f} ms")
+    for d in [int(x) for x in args.diverge.split(',')]:
+        b.put_many([(f"key{i}", 2, f"changed-{i}") for i in random.sample(range(args.keys), d)])
+        t0 = time.perf_counter()
+        la, lb = a.tree(), b.tree()
+        idx, hashes = [0], 0
+        for lvl in range(kv.KV.DEPTH + 1):
+            hashes += len(idx)
+            idx = [i for i in idx if la[lvl][i] != lb[lvl][i]]
+            if lvl < kv.KV.DEPTH:
+                idx = [c for i in idx for c in range(i * kv.KV.FANOUT, (i + 1) * kv.KV.FANOUT)]
+        shipped = len(b.leaf_items(idx))
+        print(f"diverged keys={d:>6}: buckets={len(idx):>6} hashes compared={hashes:>7} "
+              f"entries shipped={shipped:>7} ({(time.perf_counter() - t0) * 1000:.1f} ms)")
+        a.put_many(b.leaf_items(idx))
+
+# --------------------- mutex ---------------------------
+
+def _lock_writer(port: int, nid: int, name: str, stop: float, poll: bool, hold: float, log: List, lock: threading.Lock):
+    conn = kv.MuxConn(('127.0.0.1', port))
+    req = f"LOCK_REQ {nid} {name}" if poll else f"LOCK_REQ {nid} {name} 1000"
+    while time.perf_counter() < stop:
+        if conn.call(req, timeout=5) != "GRANTED":
+            time.sleep(0.05)
+            continue
+        got = time.perf_counter()
+        if hold:
+            time.sleep(hold)
+        rel = time.perf_counter()
+        with lock:
+            log.append((got, rel, nid, name))
+        conn.call(f"LOCK_REL {nid} {name}", timeout=5)
+    conn.close()
+
+
+def bench_mutex(args):
+    p = start_node(1, args.port, ['--lock-lease', '2'])
+    try:
+        print(f"{'writers':>7} {'keys':>5} {'mode':>5} {'grants/s':>9} {'handoffs/s':>10} {'handoff p50':>12} {'handoff p99':>12}")
+        for keys in [int(x) for x in args.keys.split(',')]:
+            for writers in [int(x) for x in args.writers.split(',')]:
+                log: List = []
+                lock = threading.Lock()
+                stop = time.perf_counter() + args.duration
+                ts = [threading.Thread(target=_lock_writer, args=(args.port, 100 + i, f"k{i % keys}", stop, args.poll,
+                                                                  args.hold_ms / 1000.0, log, lock))
+                      for i in range(writers)]
+                for t in ts:
+                    t.start()
+                for t in ts:
+                    t.join()
+                # handoff: from one holder deciding to release a key to another holder seeing its grant
+                gaps = []
+                for name in {e[3] for e in log}:
+                    mine = sorted(e for e in log if e[3] == name)
+                    gaps += [(mine[i][0] - mine[i - 1][1]) * 1000.0 for i in range(1, len(mine)) if mine[i][2] != mine[i - 1][2]]
+                mode = 'poll' if args.poll else 'push'
+                print(f"{writers:>7} {keys:>5} {mode:>5} {len(log) / args.duration:>9.0f} {len(gaps) / args.duration:>10.0f} "
+                      f"{pct(gaps, 0.5):>9.3f} ms {pct(gaps, 0.99):>9.3f} ms")
+    finally:
+        p.kill()
+        p.wait()
+
+# --------------------- gossip --------------------------
+
+def bench_gossip(args):
+    print(f"{'nodes':>6} {'loss':>5} {'cpu %':>6} {'B/period':>9} {'susp/member':>11} {'false dead':>10} "
+          f"{'detect first':>12} {'detect all':>10}")
+    for n in [int(x) for x in args.nodes.split(',')]:
+        peers = [('127.0.0.1', 0, args.base_port + i, i + 1) for i in range(n)]
+        members = [kv.Gossip(i + 1, args.base_port + i, peers, engine='asyncio', period=args.period, k=args.k)
+                   for i in range(n)]
+        killed = set(range(n - args.kill + 1, n + 1))
+        flips = {'susp': 0, 'dead': set()}
+        seen: Dict[int, List[float]] = {nid: [] for nid in killed}
+        kill_at = [0.0]
+
+        def watch(nid, state, flips=flips, seen=seen, kill_at=kill_at, killed=killed):
+            if nid in killed and kill_at[0]:
+                if state == kv.STATE_DEAD:
+                    seen[nid].append(time.monotonic() - kill_at[0])
+            elif state == kv.STATE_SUSPECT:
+                flips['susp'] += 1
+            elif state == kv.STATE_DEAD:
+                flips['dead'].add(nid)
+
+        def lossy(g):
+            send = g._send
+            return lambda data, addr: None if random.random() < args.loss else send(data, addr)
+        for g in members:
+            g._send = lossy(g)
+
+        async def run():
+            tasks = {g.id: asyncio.ensure_future(g.serve_async()) for g in members}
+            await asyncio.sleep(args.warmup)
+            for g in members:
+                g.on_change = watch
+            await asyncio.sleep(args.duration / 2)
+            kill_at[0] = time.monotonic()
+            for nid in killed:
+                tasks[nid].cancel()
+                members[nid - 1].transport.close()
+            await asyncio.sleep(args.duration / 2)
+            for t in tasks.values():
+                t.cancel()
+        b0 = sum(g.sent_bytes for g in members)
+        cpu0 = time.process_time()
+        asyncio.run(run())
+        cpu = (time.process_time() - cpu0) / (args.duration + args.warmup) * 100
+        per = (sum(g.sent_bytes for g in members) - b0) / n / ((args.duration + args.warmup) / args.period)
+        live = n - len(killed)
+        first = [min(v) for v in seen.values() if v]
+        full = [max(v) for v in seen.values() if len(v) >= live]
+        det1 = f"{sum(first) / len(first):.2f} s" if first else '-'
+        detn = f"{sum(full) / len(full):.2f} s" if len(full) == len(killed) and full else '-'
+        print(f"{n:>6} {args.loss:>5.2f} {cpu:>6.1f} {per:>9.0f} {flips['susp'] / n:>11.1f} {len(flips['dead']):>10} "
+              f"{det1:>12} {detn:>10}")
+        for m in members:
+            m.sock.close()
+
+# --------------------- failover ------------------------
+
+def _failover_writer(port: int, wid: int, done: threading.Event, log: List, lock: threading.Lock):
+    conn, i = None, 0
+    while not done.is_set():
+        try:
+            if conn is None:
+                conn = kv.MuxConn(('127.0.0.1', port), timeout=0.5)
+            ok = conn.call(f"PUT fo{wid % 4} w{wid}-{i}", timeout=3) == "OK"
+        except Exception:
+            ok = False
+            if conn:
+                conn.close()
+            conn = None
+        if not ok:
+            time.sleep(0.1)
+        with lock:
+            log.append((time.perf_counter(), port, ok))
+        i += 1
+
+
+def _leaders(ports: List[int]) -> Dict[int, str]:
+    out = {}
+    for port in ports:
+        try:
+            conn = kv.MuxConn(('127.0.0.1', port), timeout=0.5)
+            try:
+                out[port] = conn.call("LEADER", timeout=0.5).split()[2]
+            finally:
+                conn.close()
+        except Exception:
+            out[port] = '?'
+    return out
+
+
+def bench_failover(args):
+    n = args.nodes
+    ports = [args.port + i for i in range(n)]
+    peers = ','.join(f"127.0.0.1:{pt}:{pt + 100}={i + 1}" for i, pt in enumerate(ports))
+    extra = (['--replication', 'raft'] if args.replication == 'raft' else
+             ['--use-mutex', '1', '--lock-lease', str(args.lease)])
+    procs = {i + 1: start_node(i + 1, pt, extra, peers, n) for i, pt in enumerate(ports)}
+    log: List = []
+    lock = threading.Lock()
+    try:
+        time.sleep(3)
+        done = threading.Event()
+        t0 = time.perf_counter()
+        ws = [threading.Thread(target=_failover_writer, args=(ports[w % n], w, done, log, lock))
+              for w in range(args.writers)]
+        for t in ws:
+            t.start()
+        print(f"{'kill':>4} {'leader':>6} {'new leader':>10} {'elected in':>10} {'write gap':>10} {'failed PUTs':>11}")
+        for k in range(args.kills):
+            time.sleep(args.interval)
+            old = _leaders(ports)[ports[0]]
+            if not old.isdigit():
+                print(f"{k + 1:>4} no agreed leader before the kill")
+                continue
+            victim = int(old)
+            t_kill = time.perf_counter()
+            procs[victim].kill()
+            procs[victim].wait()
+            live = [pt for i, pt in enumerate(ports) if i + 1 != victim]
+            elected, new = None, '?'
+            while time.perf_counter() - t_kill < 15:
+                seen = set(_leaders(live).values())
+                if len(seen) == 1 and seen != {old} and next(iter(seen)).isdigit():
+                    elected, new = time.perf_counter() - t_kill, seen.pop()
+                    break
+                time.sleep(0.02)
+            time.sleep(args.lease + args.interval / 2)
+            with lock:
+                after = [e for e in log if e[0] >= t_kill]
+            oks = [t_kill] + [t for t, pt, ok in after if ok and pt != ports[victim - 1]]
+            gap = max(b - a for a, b in zip(oks + [time.perf_counter()], oks[1:] + [time.perf_counter()]))
+            failed = sum(1 for _t, pt, ok in after if not ok and pt != ports[victim - 1])
+            el = f"{elected:.2f} s" if elected is not None else 'never'
+            print(f"{k + 1:>4} {victim:>6} {new:>10} {el:>10} {gap:>8.2f} s {failed:>11}")
+            procs[victim] = start_node(victim, ports[victim - 1], extra, peers, n)
+        done.set()
+        for t in ws:
+            t.join()
+        ok = sum(1 for e in log if e[2])
+        print(f"PUTs ok={ok} failed={len(log) - ok} over {time.perf_counter() - t0:.0f} s")
+    finally:
+        for p in procs.values():
+            p.kill()
+            p.wait()
+
+# --------------------- replication ---------------------
+
+def _rw_worker(port: int, cmd: str, stop: float, lat: List[float], errors: List[int]):
+    conn = kv.MuxConn(('127.0.0.1', port))
+    i = 0
+    while time.perf_counter() < stop:
+        t0 = time.perf_counter()
+        try:
+            ok = not conn.call(cmd.format(i=i), timeout=10).startswith('ERR')
+        except Exception:
+            ok = False
+        if ok:
+            lat.append((time.perf_counter() - t0) * 1000)
+        else:
+            errors[0] += 1
+        i += 1
+    conn.close()
+
+
+def _drive_rw(ports: List[int], clients: int, cmd: str, duration: float):
+    lat: List[float] = []
+    errors = [0]
+    stop = time.perf_counter() + duration
+    ts = [threading.Thread(target=_rw_worker, args=(ports[c % len(ports)], cmd, stop, lat, errors))
+          for c in range(clients)]
+    for t in ts:
+        t.start()
+    for t in ts:
+        t.join()
+    return lat, errors[0]
+
+
+def bench_replication(args):
+    n = args.nodes
+    ports = [args.port + i for i in range(n)]
+    peers = ','.join(f"127.0.0.1:{pt}:{pt + 100}={i + 1}" for i, pt in enumerate(ports))
+    modes = {'mutex': ['--use-mutex', '1'], 'raft': ['--replication', 'raft'], 'eventual': [], 'quorum': []}
+    print(f"{'mode':8} {'op':10} {'clients':>7} {'ops/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    for mode in args.modes.split(','):
+        procs = [start_node(i + 1, pt, modes[mode] + args.extra.split(), peers, n) for i, pt in enumerate(ports)]
+        try:
+            time.sleep(3)
+            leader = kv.MuxConn(('127.0.0.1', ports[0])).call("LEADER").split()[2]
+            w = f" W={args.quorum}" if mode == 'quorum' else ''
+            rows = [('put', ports, "PUT k{i} v{i}" + w), ('put 1 key', ports, "PUT hot v{i}" + w)]
+            if mode in ('eventual', 'quorum'):
+                rows.append(('get', ports, "GET k{i}" + (f" R={args.quorum}" if w else '')))
+            elif leader.isdigit():
+                lp = ports[int(leader) - 1]
+                rows += [('get leader', [lp], "GET k{i}"), ('get follow', [p for p in ports if p != lp], "GET k{i}")]
+            for op, targets, cmd in rows:
+                lat, errs = _drive_rw(targets, args.clients, cmd, args.duration)
+                print(f"{mode:8} {op:10} {args.clients:>7} {len(lat) / args.duration:>9.0f} "
+                      f"{pct(lat, 0.5):>8.2f} {pct(lat, 0.99):>8.2f} {errs:>7}")
+        finally:
+            for p in procs:
+                p.kill()
+                p.wait()
+        time.sleep(0.5)
+
+# --------------------- layers --------------------------
+
+def synth_trace(count: int, nodes: int, jitter: int, seed: int=1) -> List[kv.TraceEvent]:
+    """Events from `nodes` nodes exchanging messages, delivered with some reordering."""
+    rnd = random.Random(seed)
+    vec = [[0] * nodes for _ in range(nodes)]
+    lam = [0] * nodes
+    sent: List[List[Dict]] = [[] for _ in range(nodes)]
+    out = []
+    for t in range(count):
+        i = rnd.randrange(nodes)
+        if sent[i] and rnd.random() < 0.3:
+            msg = sent[i].pop(rnd.randrange(len(sent[i])))
+            lam[i] = max(lam[i], msg['lamport']) + 1
+            vec[i] = [max(a, b) for a, b in zip(vec[i], msg['vector'])]
+        else:
+            lam[i] += 1
+        vec[i][i] += 1
+        ev = {'node': i + 1, 'stage': 'S', 'op': str(t), 'phy_ts': float(t), 'lamport': lam[i], 'vector': list(vec[i])}
+        if rnd.random() < 0.3:
+            sent[rnd.choice([j for j in range(nodes) if j != i] or [i])].append(ev)
+        out.append(ev)
+    # arrival order: each event delayed by up to `jitter` positions
+    late = sorted(((i + rnd.randint(0, jitter), e) for i, e in enumerate(out)), key=lambda x: x[0])
+    return [kv.TraceEvent(seq, 0.0, e) for seq, (_, e) in enumerate(late)]
+
+
+def naive_layers(evs: List[kv.TraceEvent]) -> List[List[kv.TraceEvent]]:
+    """The Logger's original per-tick recomputation, kept here as the reference."""
+    def vc_leq(a, b):
+        return all(x <= y for x, y in zip(a, b))
+    used = set()
+    layers: List[List[kv.TraceEvent]] = []
+    while len(used) < len(evs):
+        layer = []
+        for i, e in enumerate(evs):
+            if i in used:
+                continue
+            before = False
+            for j, o in enumerate(evs):
+                if j in used or j == i:
+                    continue
+                if vc_leq(o.vector, e.vector) and o.vector != e.vector:
+                    before = True
+                    break
+            if not before:
+                layer.append(e)
+        if not layer:
+            break
+        layers.append(layer)
+        for e in layer:
+            used.add(evs.index(e))
+    return layers
+
+
+def bench_layers(args):
+    check = synth_trace(400, args.nodes, args.jitter, seed=7)
+    idx = kv.CausalIndex()
+    for e in check:
+        idx.add(e)
+    want = [sorted(e.op for e in l) for l in naive_layers(check)]
+    got = [sorted(e.op for e in l) for l in idx.layered()]
+    print(f"check (400 events, {args.nodes} nodes): {'OK' if want == got else 'MISMATCH'}")
+    print(f"{'events':>8} {'index add':>12} {'per event':>10} {'layers':>7} {'naive tick':>11}")
+    for n in [int(x) for x in args.events.split(',')]:
+        evs = synth_trace(n, args.nodes, args.jitter)
+        t0 = time.perf_counter()
+        idx = kv.CausalIndex()
+        for e in evs:
+            idx.add(e)
+        layers = idx.layered()
+        dt = time.perf_counter() - t0
+        naive = '-'
+        if n <= args.naive_max:
+            t0 = time.perf_counter()
+            naive_layers(evs)
+            naive = f"{time.perf_counter() - t0:.2f} s"
+        print(f"{n:>8} {dt:>10.3f} s {dt / n * 1e6:>7.1f} us {len(layers):>7} {naive:>11}")
+
+# --------------------- binary --------------------------
+
+def bench_binary(args):
+    """PUT awkward values through one node over mux, then GET them back byte for byte from every node."""
+    n = args.nodes
+    ports = [args.port + i for i in range(n)]
+    peers = ','.join(f"127.0.0.1:{pt}:{pt + 100}={i + 1}" for i, pt in enumerate(ports))
+    rnd = random.Random(1)
+    values = [b' lead', b'trail ', b'\x1c\x1d\x1e\x1f', b'a\r\n', b'\n', b'\t\x0b\x0c', b'\xff\xfe not utf-8',
+              bytes(range(256)), b' W=2x']
+    values += [bytes(rnd.randrange(256) for _ in range(rnd.randrange(1, 4096))) for _ in range(args.values)]
+    ok = True
+    for engine in args.engines.split(','):
+        procs = [start_node(i + 1, pt, ['--engine', engine] + args.extra.split(), peers, n) for i, pt in enumerate(ports)]
+        try:
+            time.sleep(2)
+            conns = [kv.MuxConn(('127.0.0.1', pt)) for pt in ports]
+            errors = sum(conns[0].call(f"PUT bin{i} {kv.b2s(v)}", timeout=5) != 'OK' for i, v in enumerate(values))
+            time.sleep(1)
+            bad = sum(kv.s2b(c.call(f"GET bin{i}", timeout=5)) != v for c in conns for i, v in enumerate(values))
+            print(f"{engine:8} {len(values)} values x {n} nodes: {errors} PUT errors, {bad} mismatches")
+            ok = ok and not errors and not bad
+            for c in conns:
+                c.close()
+        finally:
+            for p in procs:
+                p.kill()
+                p.wait()
+        time.sleep(0.5)
+    print('OK' if ok else 'MISMATCH')
+
+# --------------------- Main ----------------------------
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(description='kv benchmarks')
+    sub = ap.add_subparsers(dest='bench', required=True)
+
+    sp = sub.add_parser('engines', help='thread vs asyncio server engine under many connections')
+    sp.add_argument('--engines', default='thread,asyncio')
+    sp.add_argument('--conns', type=int, default=1000)
+    sp.add_argument('--duration', type=float, default=10.0)
+    sp.add_argument('--put-ratio', type=float, default=0.1)
+    sp.add_argument('--mode', choices=['mux', 'oneshot'], default='mux')
+    sp.add_argument('--port', type=int, default=8801)
+
+    sp = sub.add_parser('shards', help='multi-threaded KV store microbenchmark per stripe count')
+    sp.add_argument('--shards', default='1,4,16,64')
+    sp.add_argument('--threads', type=int, default=8)
+    sp.add_argument('--ops', type=int, default=200000, help='operations per thread')
+    sp.add_argument('--keys', type=int, default=10000)
+
+    sp = sub.add_parser('wal', help='PUT throughput with durability on, and recovery time')
+    sp.add_argument('--threads', default='1,8,32')
+    sp.add_argument('--ops', type=int, default=2000, help='PUTs per thread')
+    sp.add_argument('--keys', type=int, default=1000000, help='store size for the recovery run')
+    sp.add_argument('--dir', default=None, help='parent directory for the data (default: system temp)')
+
+    sp = sub.add_parser('ae', help='anti-entropy Merkle cost on a large store')
+    sp.add_argument('--keys', type=int, default=1000000)
+    sp.add_argument('--diverge', default='10,1000', help='comma list of divergent key counts')
+
+    sp = sub.add_parser('mutex', help='leader mutex handoff latency under contention')
+    sp.add_argument('--writers', default='3,8,16')
+    sp.add_argument('--duration', type=float, default=5.0)
+    sp.add_argument('--keys', default='1', help='comma list of distinct lock names the writers spread over')
+    sp.add_argument('--hold-ms', type=float, default=0.0, help='time each holder keeps the lock')
+    sp.add_argument('--poll', action='store_true', help='use non-blocking LOCK_REQ with 50 ms polling, as before')
+    sp.add_argument('--port', type=int, default=8801)
+
+    sp = sub.add_parser('gossip', help='SWIM detector cost and accuracy with many in-process members over lossy UDP')
+    sp.add_argument('--nodes', default='50,200', help='comma list of cluster sizes')
+    sp.add_argument('--duration', type=float, default=20.0, help='measured time; --kill members stop halfway')
+    sp.add_argument('--warmup', type=float, default=5.0)
+    sp.add_argument('--loss', type=float, default=0.0, help='fraction of datagrams dropped on send')
+    sp.add_argument('--kill', type=int, default=1, help='members stopped halfway, to time their detection')
+    sp.add_argument('--period', type=float, default=0.5)
+    sp.add_argument('--k', type=int, default=3, help='ping-req fan-out')
+    sp.add_argument('--base-port', type=int, default=20000, help='first UDP port; one per member')
+
+    sp = sub.add_parser('failover', help='write availability under the leader mutex across leader kills')
+    sp.add_argument('--nodes', type=int, default=3)
+    sp.add_argument('--kills', type=int, default=3)
+    sp.add_argument('--interval', type=float, default=6.0, help='seconds between kills')
+    sp.add_argument('--writers', type=int, default=6)
+    sp.add_argument('--lease', type=float, default=2.0, help='--lock-lease of the nodes')
+    sp.add_argument('--replication', choices=['mutex', 'raft'], default='mutex')
+    sp.add_argument('--port', type=int, default=8811)
+
+    sp = sub.add_parser('replication', help='PUT/GET throughput and latency: leader mutex vs raft log vs quorums')
+    sp.add_argument('--modes', default='mutex,raft', help='comma list of mutex, raft, eventual, quorum')
+    sp.add_argument('--quorum', type=int, default=2, help='R and W of the quorum mode')
+    sp.add_argument('--nodes', type=int, default=3)
+    sp.add_argument('--clients', type=int, default=64)
+    sp.add_argument('--duration', type=float, default=10.0)
+    sp.add_argument('--extra', default='', help='extra kv.py flags for every node, e.g. "--data-dir /tmp/x"')
+    sp.add_argument('--port', type=int, default=8821)
+
+    sp = sub.add_parser('layers', help='logger causal layering: incremental index vs full recomputation')
+    sp.add_argument('--events', default='10000,100000', help='comma list of trace sizes')
+    sp.add_argument('--nodes', type=int, default=3)
+    sp.add_argument('--jitter', type=int, default=20, help='max positions an event arrives late')
+    sp.add_argument('--naive-max', type=int, default=1000, help='largest trace the old algorithm is run on')
+
+    sp = sub.add_parser('binary', help='byte-exact PUT/GET round trip of whitespace, control and non-UTF-8 values')
+    sp.add_argument('--engines', default='thread,asyncio')
+    sp.add_argument('--nodes', type=int, default=3)
+    sp.add_argument('--values', type=int, default=200, help='random values on top of the fixed edge cases')
+    sp.add_argument('--extra', default='', help='extra kv.py flags for every node, e.g. "--use-mutex 1"')
+    sp.add_argument('--port', type=int, default=8831)
+
+    args = ap.parse_args()
+    if args.bench == 'engines':
+        bench_engines(args)
+    elif args.bench == 'shards':
+        bench_shards(args)
+    elif args.bench == 'wal':
+        bench_wal(args)
+    elif args.bench == 'ae':
+        bench_ae(args)
+    elif args.bench == 'mutex':
+        bench_mutex(args)
+    elif args.bench == 'gossip':
+        bench_gossip(args)
+    elif args.bench == 'failover':
+        bench_failover(args)
+    elif args.bench == 'replication':
+        bench_replication(args)
+    elif args.bench == 'layers':
+        bench_layers(args)
+    elif args.bench == 'binary':
+        bench_binary(args)